@@ -1,55 +1,415 @@
-from flask import Flask, request, jsonify, make_response, send_file
+from flask import Flask, Response, request, jsonify, make_response, send_file, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import joinedload
+from sqlalchemy.engine import Engine
+from sqlalchemy import event, inspect
 from flask_restful import Resource, Api
 from flask_marshmallow import Marshmallow
-from celerytask import RunSymbiFlow
+from celerytask import app as celery_app, RunSymbiFlow, ProgramBoard, PurgeDeleted, ReleaseInflight, registry, cache, rdb, INFLIGHT_PREFIX, INFLIGHT_TTL
+from buildcache import HashSources, BitstreamHash, BUILD_DIR
+from retention import ArtifactPath, ArtifactChunks, IsArchived, DirSize
+from blobstore import BlobStore
+from tombstone import Trash
+from verilogscan import ScanIndex, ScanFile, IsVerilog, CheckHierarchy
+from artifactstore import MakeStore, PushSources, ArtifactKey, BuildLogKey
+from buildlog import FollowLog, LogKey
+from buildstatus import WaitStatus, FollowStatus, PublishStatus
+from cancel import RequestCancel, CANCELLED
+from scheduler import PriorityFor, PRIORITIES, DEFAULT_PRIORITY
+from profiler import ShouldProfile, StartProfile, ProfileStore, PROFILE_HEADER
+from metrics import REQUEST_LATENCY, DB_QUERIES, QueueCollector, CacheCollector, MakeRegistry, Exposition
 from celery.result import AsyncResult
-import os, json, shutil
+from celery import states, group
+import os, json, shutil, uuid, tarfile, zipfile, tempfile, sqlite3, zlib, hashlib, datetime, time, redis
 
 app = Flask(__name__)
 api = Api(app)
-# Configuring the database path
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data.db'
+# Configuring the database path, any SQLAlchemy URI (e.g. postgresql://) works
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SYMBIFLASK_DATABASE_URI', 'sqlite:///data.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# connection pool for server databases, SQLite keeps the driver defaults
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('SYMBIFLASK_DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('SYMBIFLASK_DB_MAX_OVERFLOW', 20)),
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+# content addressed HDL storage shared by all projects
+blobs = BlobStore()
+# shared store for builds on other hosts, None when the workers run here
+store = MakeStore()
+# modules declared and instantiated by every stored verilog content
+scans = ScanIndex(rdb)
+# profile store and the token guarding the admin endpoints, closed while unset
+profiles = ProfileStore()
+ADMIN_TOKEN = os.environ.get('SYMBIFLASK_ADMIN_TOKEN')
+# longest a status request may block with ?wait=
+MAX_STATUS_WAIT = 60
+# largest page for keyset pagination, rows fetched per round trip when streaming
+MAX_PAGE = 1000
+STREAM_BATCH = 500
+# batch build registry
+BATCH_PREFIX = "symbiflask:batch:"
+BATCH_TTL = 7 * 24 * 3600
 # database object
 db = SQLAlchemy(app)
 # marshmallow object
 ma = Marshmallow(app)
 
+# SQLite tuning: WAL lets readers run alongside the writer
+@event.listens_for(Engine, "connect")
+def SetSqlitePragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-16000")
+        cursor.close()
+
+
+# count the queries issued while serving a request
+@event.listens_for(Engine, "before_cursor_execute")
+def CountQuery(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        if 'profile_queries' in g:
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+# query timings of profiled requests
+@event.listens_for(Engine, "after_cursor_execute")
+def TimeQuery(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile_queries' in g and conn.info.get('query_start'):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        g.profile_queries.append({'statement': statement, 'seconds': elapsed})
+
+
+# request instrumentation
+@app.before_request
+def StartTimer():
+    g.started = time.perf_counter()
+    g.db_queries = 0
+    # opt-in profile, asked with the header or sampled
+    if ShouldProfile(request.headers.get(PROFILE_HEADER) == "1"):
+        profile = StartProfile()
+        if profile is not None:
+            g.profile = profile
+            g.profile_queries = []
+
+
+@app.after_request
+def RecordRequest(response):
+    if 'started' in g:
+        elapsed = time.perf_counter() - g.started
+        resource = request.endpoint or "unknown"
+        REQUEST_LATENCY.labels(resource, request.method, response.status_code).observe(elapsed)
+        DB_QUERIES.labels(resource, request.method).observe(g.get('db_queries', 0))
+    if 'profile' in g:
+        g.profile.disable()
+        try:
+            profile_id = profiles.save("request", request.method + " " + request.full_path, g.profile,
+                                       resource=request.endpoint, status=response.status_code,
+                                       duration=elapsed, queries=g.profile_queries,
+                                       query_seconds=sum(q['seconds'] for q in g.profile_queries))
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception as e:
+            print(e)
+    return response
+
+
+# a declared string length above the one of the existing column
+def Widened(declared, current):
+    length = getattr(declared, 'length', None)
+    current_length = getattr(current, 'length', None)
+    return length is not None and current_length is not None and length > current_length
+
+
 #check if database exists
 def checkdatabase():
-    if os.path.exists("data.db"):
-        print("database file found")
-        return True
+    found = inspect(db.engine).has_table("FPGA")
+    if found:
+        print("database found")
     else:
-        print("database file non found, creating new")
-        db.create_all()
-        return False
+        print("database non found, creating new")
+    db.create_all()
+    # databases created before a column or index was declared get it now
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {c['name']: c['type'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            if column.name not in existing:
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, column_type))
+            # string columns declared wider since, sqlite does not enforce lengths
+            elif db.engine.dialect.name == "postgresql" and Widened(column.type, existing[column.name]):
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql('ALTER TABLE "%s" ALTER COLUMN "%s" TYPE %s' % (table.name, column.name, column_type))
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    return found
+
+
+# function to tombstone a project and its files, the rows and the directory
+# moved to the trash are removed later by the PurgeDeleted task
+def RecursiveHDLDelete(query_id, dir_name):
+    now = datetime.datetime.utcnow()
+    # one statement for every file of the project
+    HDL_file.query.filter_by(Project_id=query_id, deleted_at=None).update({'deleted_at': now}, synchronize_session=False)
+    Project.query.filter_by(id=query_id).update({'deleted_at': now}, synchronize_session=False)
+    db.session.commit()
+    return Trash(dir_name)
 
 
-# function to recursively delete a project dir
-def RecursiveHDLDelete(query_id, dir_name):
+# hand tombstoned rows and trashed paths to the background purge
+def SchedulePurge(**kwargs):
     try:
-        # gather record list
-        db_list = HDL_file.query.filter_by(Project_id=query_id).all()
-        # delete directory
-        shutil.rmtree(dir_name, ignore_errors=True)
-        # cycle records
-        for row in db_list:
-            db.session.delete(row)
+        return PurgeDeleted.apply_async(kwargs=kwargs).id
     except Exception as e:
+        # the sweep at worker start picks the deletion up
         print(e)
-        raise "Recursive delete failed"
-        return
-    else:
+        return None
+
+
+# tombstoned files in the way of new ones are dropped at once, returns their blobs
+def DropTombstoned(Project_id, names):
+    rows = HDL_file.query.filter(HDL_file.Project_id == Project_id, HDL_file.file_name.in_(names),
+                                 HDL_file.deleted_at.isnot(None)).all()
+    for row in rows:
+        db.session.delete(row)
+    # deletes must reach the unique index before the inserts replacing them
+    db.session.flush()
+    return {row.content_hash for row in rows if row.content_hash}
+
+
+# drop the blobs no HDL_file refers to anymore, call after commit
+def CollectBlobs(hashes):
+    hashes = set(hashes)
+    if not hashes:
         return
+    try:
+        # reference count of every blob in one query
+        used = {h for (h,) in db.session.query(HDL_file.content_hash).filter(HDL_file.content_hash.in_(hashes)).distinct()}
+        for digest in hashes - used:
+            blobs.remove(digest)
+        scans.drop(list(hashes - used))
+    except Exception as e:
+        print(e)
+
+
+# index an uploaded content, a failed scan is redone by the next preflight
+def IndexScan(content_hash, file_name):
+    try:
+        scans.index(content_hash, blobs.path(content_hash), file_name)
+    except Exception as e:
+        print(e)
+
+
+# check the hierarchy below the top file before any container starts,
+# returns (error, files reachable from the top module, warning)
+def Preflight(data, top_level):
+    rows = db.session.query(HDL_file.file_name, HDL_file.content_hash) \
+        .filter(HDL_file.Project_id == data.id, HDL_file.deleted_at.is_(None)).all()
+    hashes = sorted({content_hash for file_name, content_hash in rows if content_hash and IsVerilog(file_name)})
+    cached = dict(zip(hashes, scans.get(hashes)))
+    files = {}
+    for file_name, content_hash in rows:
+        if not IsVerilog(file_name):
+            files[file_name] = None
+            continue
+        scan = cached.get(content_hash)
+        if scan is None:
+            # not indexed yet, or uploaded before content hashing
+            if content_hash and blobs.has(content_hash):
+                scan = ScanFile(blobs.path(content_hash))
+                scans.put(content_hash, scan)
+            else:
+                scan = ScanFile(os.path.join(ProjectDir(data), file_name))
+        files[file_name] = scan
+    return CheckHierarchy(files, top_level.file_name)
+
+
+# rows that are not waiting for deletion
+def Live(model):
+    return model.query.filter(model.deleted_at.is_(None))
+
+
+# fetch a project together with its FPGA in one query
+def GetProject(id):
+    return Live(Project).options(joinedload(Project.fpga)).filter(Project.id == id).first()
+
+
+# fetch an HDL file together with its project and FPGA in one query
+def GetHDL(id):
+    return Live(HDL_file).options(joinedload(HDL_file.project).joinedload(Project.fpga)).filter(HDL_file.id == id).first()
+
+
+# host folder of a project
+def ProjectDir(project, fpga_data=None):
+    fpga_data = fpga_data or project.fpga
+    return os.path.join(os.getcwd(), project.Project_name + "_" + fpga_data.model_id)
+
+
+# parse a boolean query argument
+def ArgBool(value):
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise ValueError(value)
+
+
+# list a table with filters, sparse fields, keyset pagination and streaming
+def ListRows(model, schema_cls, filters, empty_error):
+    args = request.args
+    query = Live(model) if hasattr(model, 'deleted_at') else model.query
+    # server side filters
+    for name, cast in filters.items():
+        if name in args:
+            try:
+                query = query.filter(getattr(model, name) == cast(args[name]))
+            except ValueError:
+                return "Error: invalid value for " + name, 400
+    # sparse field selection
+    try:
+        only = args['fields'].split(",") if 'fields' in args else None
+        data_schema = schema_cls(only=only)
+    except ValueError as e:
+        return "Error: invalid fields " + str(e), 400
+    # keyset pagination on the primary key
+    try:
+        cursor = int(args['cursor']) if 'cursor' in args else None
+        limit = min(int(args['limit']), MAX_PAGE) if 'limit' in args else None
+    except ValueError:
+        return "Error: invalid cursor or limit", 400
+    if limit is not None and limit < 1:
+        return "Error: limit must be at least 1", 400
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    query = query.order_by(model.id)
+
+    # one page with the cursor of the next one
+    if limit is not None and args.get('format') != 'ndjson':
+        rows = query.limit(limit + 1).all()
+        next_cursor = rows[limit - 1].id if len(rows) > limit else None
+        return jsonify({'items': data_schema.dump(rows[:limit], many=True), 'next_cursor': next_cursor})
+
+    if limit is not None:
+        query = query.limit(limit)
+    rows = iter(query.yield_per(STREAM_BATCH))
+    first = next(rows, None)
+    if first is None and len(args) == 0:
+        return empty_error, 404
+
+    # rows are serialized one at a time while the response is sent
+    if args.get('format') == 'ndjson':
+        def ndjson():
+            if first is None:
+                return
+            yield json.dumps(data_schema.dump(first)) + "\n"
+            for row in rows:
+                yield json.dumps(data_schema.dump(row)) + "\n"
+        return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+
+    def array():
+        yield "["
+        if first is not None:
+            yield json.dumps(data_schema.dump(first))
+            for row in rows:
+                yield "," + json.dumps(data_schema.dump(row))
+        yield "]"
+    return Response(stream_with_context(array()), mimetype='application/json')
 
 
 # function to set up symbiflow
-def SymbiflowHelper(data, mode):
+def SymbiflowHelper(data, top_level, mode, priority=DEFAULT_PRIORITY, sources=None):
     # gather data from the database
-    fpga_data = FPGA.query.get(data.FPGA_id)
-    top_level = HDL_file.query.filter_by(Project_id=data.id, top_level_flag=True).first()
+    fpga_data = data.fpga
+    # prepare the run, unless an identical one is in flight
+    task_id, sig = SymbiflowSignature(data, fpga_data, top_level, mode, priority, sources)
+    if sig is not None:
+        try:
+            # the history row exists before the worker can pick the task up
+            db.session.commit()
+            sig.apply_async()
+        except Exception:
+            ReleaseInflight(sig.kwargs['INFLIGHT_KEY'], task_id)
+            Build.query.filter_by(task_id=task_id).delete()
+            db.session.commit()
+            raise
+    return task_id
+
+
+# status and result of a task, from the build history when it is there
+def TaskStatus(task_id):
+    build = Build.query.filter_by(task_id=task_id).populate_existing().first()
+    if build is not None:
+        return BuildStatus(build)
+    task_result = RunSymbiFlow.AsyncResult(task_id)
+    return task_result.status, task_result.result
+
+
+# map a history row onto the task status, RunSymbiFlow returns True on failure
+def BuildStatus(build):
+    if build.status == states.REVOKED:
+        return states.REVOKED, None
+    if build.finished_at is not None:
+        return states.SUCCESS, build.exit_status != 0
+    return build.status, None
+
+
+# source fingerprint from the stored content hashes, no file is read
+def ProjectFingerprint(project_id):
+    rows = db.session.query(HDL_file.file_name, HDL_file.content_hash) \
+        .filter(HDL_file.Project_id == project_id, HDL_file.deleted_at.is_(None)).order_by(HDL_file.file_name).all()
+    # files uploaded before hashing was introduced
+    if not rows or any(content_hash is None for _, content_hash in rows):
+        return None
+    h = hashlib.sha256()
+    for file_name, content_hash in rows:
+        h.update(file_name.encode() + b"\0" + content_hash.encode() + b"\n")
+    return h.hexdigest()
+
+
+# fingerprint of a build request, the same sources built for another part or
+# from another top file make a different build
+def BuildFingerprint(source_hash, PART_NAME, TOP_FILE):
+    h = hashlib.sha256()
+    for item in (source_hash, PART_NAME, TOP_FILE):
+        h.update(item.encode() + b"\0")
+    return h.hexdigest()
+
+
+# last successful build of the same inputs, when its bitstream is still stored
+def UnchangedBuild(project_id, part, mode, build_hash):
+    build = Build.query.filter_by(Project_id=project_id, part=part, mode=mode, source_hash=build_hash,
+                                  status=states.SUCCESS, exit_status=0) \
+        .filter(Build.pruned_at.is_(None)).order_by(Build.id.desc()).first()
+    if build and build.artifact_hash and HasArtifact(build.artifact_hash):
+        return build
+    return None
+
+
+def HasArtifact(artifact_hash):
+    return IsArchived(artifact_hash) or (store is not None and store.has(ArtifactKey(artifact_hash)))
+
+
+# make an archived bitstream local, fetching it from the shared store on first use
+def FetchArtifact(artifact_hash):
+    if not IsArchived(artifact_hash):
+        if store is None or not store.has(ArtifactKey(artifact_hash)):
+            return False
+        os.makedirs(os.path.dirname(ArtifactPath(artifact_hash)), exist_ok=True)
+        store.get(ArtifactKey(artifact_hash), ArtifactPath(artifact_hash))
+    return True
+
+
+# function to prepare a symbiflow run, returns the task id and the
+# signature to enqueue (None when an identical build is in flight)
+def SymbiflowSignature(data, fpga_data, top_level, mode, priority=DEFAULT_PRIORITY, sources=None):
     # FPGA model
     PART_NAME = fpga_data.model_id
     # top level entity file
@@ -57,10 +417,38 @@ def SymbiflowHelper(data, mode):
     # container project folder
     PRJ_DIR = os.path.join("/symb", data.Project_name + "_" + fpga_data.model_id)
     # host project folder
-    PRJ_DIR_HOST = os.path.join(os.getcwd(), data.Project_name + "_" + fpga_data.model_id)
-    # run symbiflow
-    res = RunSymbiFlow.delay(PART_NAME=PART_NAME, PRJ_DIR=PRJ_DIR, PRJ_DIR_HOST=PRJ_DIR_HOST, TOP_FILE=TOP_FILE, mode=mode)
-    return res.id
+    PRJ_DIR_HOST = ProjectDir(data, fpga_data)
+    # identical requests share the build already queued or running. Every
+    # file is hashed, the reachable ones are only a hint for the image
+    source_hash = ProjectFingerprint(data.id) or HashSources(PRJ_DIR_HOST)
+    build_hash = BuildFingerprint(source_hash, PART_NAME, TOP_FILE)
+    inflight_key = INFLIGHT_PREFIX + str(data.id) + ":" + build_hash + ":" + str(mode)
+    task_id = str(uuid.uuid4())
+    while not rdb.set(inflight_key, task_id, nx=True, ex=INFLIGHT_TTL):
+        current = rdb.get(inflight_key)
+        if current is None:
+            continue
+        current = current.decode()
+        if TaskStatus(current)[0] not in states.READY_STATES:
+            return current, None
+        # stale entry of a finished build
+        ReleaseInflight(inflight_key, current)
+    # workers on other hosts get the sources through the shared store
+    try:
+        bundle = PushSources(store, PRJ_DIR_HOST, source_hash) if store is not None else None
+    except Exception:
+        ReleaseInflight(inflight_key, task_id)
+        raise
+    # symbiflow run
+    sig = RunSymbiFlow.signature(kwargs=dict(PART_NAME=PART_NAME, PRJ_DIR=PRJ_DIR, PRJ_DIR_HOST=PRJ_DIR_HOST,
+                                             TOP_FILE=TOP_FILE, mode=mode, INFLIGHT_KEY=inflight_key,
+                                             PROJECT_ID=data.id, ENQUEUED_AT=time.time(),
+                                             PROFILE=has_request_context() and 'profile' in g, BUNDLE=bundle,
+                                             PRIORITY=priority, SOURCES=sources),
+                                 task_id=task_id, priority=PriorityFor(priority))
+    # history row, committed by the caller before enqueueing
+    db.session.add(Build(task_id, data.id, PART_NAME, mode, build_hash))
+    return task_id, sig
 
 
 # FPGA entity
@@ -69,9 +457,12 @@ class FPGA(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     family = db.Column(db.String(20))
-    model_id = db.Column(db.String(20), unique=False)
+    model_id = db.Column(db.String(64), unique=False)
     builder = db.Column(db.String(20))
 
+    # existence check on insert and update
+    __table_args__ = (db.Index('ix_FPGA_family_model_builder', 'family', 'model_id', 'builder'),)
+
     def __init__(self, family, model_id, builder):
         self.family = family
         self.model_id = model_id
@@ -90,8 +481,14 @@ class Project(db.Model):
     __tablename__ = "Project"
 
     id = db.Column(db.Integer, primary_key=True)
-    Project_name = db.Column(db.String(20), unique=False)
+    Project_name = db.Column(db.String(255), unique=False)
     FPGA_id = db.Column(db.Integer, db.ForeignKey('FPGA.id'))
+    fpga = db.relationship('FPGA')
+    # set on delete, the row is removed by the purge task
+    deleted_at = db.Column(db.DateTime)
+
+    # one project name per FPGA
+    __table_args__ = (db.Index('ix_Project_name_FPGA', 'Project_name', 'FPGA_id', unique=True),)
 
     def __init__(self, Project_name, FPGA_id):
         self.Project_name = Project_name
@@ -111,13 +508,24 @@ class HDL_file(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     Project_id = db.Column(db.Integer, db.ForeignKey('Project.id'), nullable=False)
-    file_name = db.Column(db.String(20))
+    project = db.relationship('Project')
+
+    # one file name per project, fast top level lookup
+    __table_args__ = (db.Index('ix_HDL_file_project_name', 'Project_id', 'file_name', unique=True),
+                      db.Index('ix_HDL_file_project_top', 'Project_id', 'top_level_flag'),
+                      db.Index('ix_HDL_file_content', 'content_hash'))
+    file_name = db.Column(db.String(255))
     top_level_flag = db.Column(db.Boolean, nullable=False)
+    # sha256 of the content, key in the blob store
+    content_hash = db.Column(db.String(64))
+    # set on delete, the row is removed by the purge task
+    deleted_at = db.Column(db.DateTime)
 
-    def __init__(self, Project_id, file_name, top_level_flag):
+    def __init__(self, Project_id, file_name, top_level_flag, content_hash=None):
         self.Project_id = Project_id
         self.file_name = file_name
         self.top_level_flag = top_level_flag
+        self.content_hash = content_hash
 
 
 # HDL_file Schema
@@ -127,6 +535,50 @@ class HDL_fileSchema(ma.SQLAlchemyAutoSchema):
         include_fk = True
 
 
+# Build entity, written by the worker
+class Build(db.Model):
+    __tablename__ = "Build"
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String(36), nullable=False)
+    Project_id = db.Column(db.Integer, db.ForeignKey('Project.id'))
+    part = db.Column(db.String(64))
+    mode = db.Column(db.Integer)
+    # BuildFingerprint of the sources, part and top file
+    source_hash = db.Column(db.String(64))
+    status = db.Column(db.String(20), nullable=False)
+    exit_status = db.Column(db.Integer)
+    queued_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # JSON map of stage name to [start, end]
+    stage_times = db.Column(db.Text)
+    artifact_size = db.Column(db.Integer)
+    artifact_hash = db.Column(db.String(64))
+    # set once the retention policy dropped the bitstream of this build
+    pruned_at = db.Column(db.DateTime)
+
+    # status lookups by task, history listings by project
+    __table_args__ = (db.Index('ix_Build_task', 'task_id', unique=True),
+                      db.Index('ix_Build_project', 'Project_id', 'id'))
+
+    def __init__(self, task_id, Project_id, part, mode, source_hash):
+        self.task_id = task_id
+        self.Project_id = Project_id
+        self.part = part
+        self.mode = mode
+        self.source_hash = source_hash
+        self.status = "PENDING"
+        self.queued_at = datetime.datetime.utcnow()
+
+
+# Build Schema
+class BuildSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = Build
+        include_fk = True
+
+
 # FPGA Table manager
 class manage_fpga(Resource):
     # LIST FPGA
@@ -138,11 +590,7 @@ class manage_fpga(Resource):
             id = None
 
         if not id:
-            data = FPGA.query.all()
-            if not data:
-                return "Error: No FPGAs in table", 404
-            data_schema = FPGASchema(many=True)
-            return jsonify(data_schema.dump(data))
+            return ListRows(FPGA, FPGASchema, {'family': str, 'model_id': str, 'builder': str}, "Error: No FPGAs in table")
         else:
             data = FPGA.query.get(id)
             if not data:
@@ -249,13 +697,9 @@ class manage_project(Resource):
             id = None
 
         if not id:
-            data = Project.query.all()
-            if not data:
-                return "Error: No Projects in table", 404
-            data_schema = ProjectSchema(many=True)
-            return jsonify(data_schema.dump(data))
+            return ListRows(Project, ProjectSchema, {'Project_name': str, 'FPGA_id': int}, "Error: No Projects in table")
         else:
-            data = Project.query.get(id)
+            data = Live(Project).filter(Project.id == id).first()
             if not data:
                 return "Error: The Project doesn't exist", 404
             data_schema = ProjectSchema()
@@ -270,15 +714,16 @@ class manage_project(Resource):
         # Check if already exists
         check = Project.query.filter_by(Project_name=Project_name, FPGA_id=FPGA_id).first()
         if check:
+            if check.deleted_at is not None:
+                return "Error: project is being deleted, retry later", 409
             return "Error: project already exists", 400
 
         # Creating the record
         data = Project(Project_name, FPGA_id)
 
         # finding folder name for proj
-        Curr = os.getcwd()
         tmp = FPGA.query.get(FPGA_id)
-        dir_name = os.path.join(Curr, Project_name + "_" + tmp.model_id)
+        dir_name = ProjectDir(data, tmp)
 
         try:
             db.session.add(data)
@@ -302,7 +747,7 @@ class manage_project(Resource):
             return "Error: No ID for UPDATE", 400
         else:
             try:
-                data = Project.query.get(id)
+                data = GetProject(id)
                 Project_name = request.json['Project_name']
                 FPGA_id = request.json['FPGA_id']
 
@@ -313,17 +758,16 @@ class manage_project(Resource):
 
                 # check if changes
 
-                Curr = os.getcwd()
                 # get old dir name
-                tmp_src = FPGA.query.get(data.FPGA_id)
-                dir_name_src = os.path.join(Curr, data.Project_name + "_" + tmp_src.model_id)
+                dir_name_src = ProjectDir(data)
                 # get new dir name
-                tmp_dst = FPGA.query.get(FPGA_id)
-                dir_name_dst = os.path.join(Curr, Project_name + "_" + tmp_dst.model_id)
+                tmp_dst = data.fpga if data.FPGA_id == FPGA_id else FPGA.query.get(FPGA_id)
+                dir_name_dst = os.path.join(os.getcwd(), Project_name + "_" + tmp_dst.model_id)
 
                 # update row
                 data.Project_name = Project_name
                 data.FPGA_id = FPGA_id
+                data.fpga = tmp_dst
                 # update dir
                 os.rename(dir_name_src, dir_name_dst)
 
@@ -346,28 +790,24 @@ class manage_project(Resource):
             return "Error: No ID for DELETE", 400
         else:
             try:
-                data = Project.query.get(id)
+                data = GetProject(id)
 
                 # check if exists
                 if data is None:
                     return "Error: project doesn't exists", 412
 
                 # finding folder name for proj
-                Curr = os.getcwd()
-                tmp = FPGA.query.get(data.FPGA_id)
-                dir_name = os.path.join(Curr, data.Project_name + "_" + tmp.model_id)
+                dir_name = ProjectDir(data)
 
-                # remove files attached to project
-                RecursiveHDLDelete(id, dir_name)
-
-                # remove the project
-                db.session.delete(data)
-                db.session.commit()
+                # hide the project at once, files and rows go in the background
+                trash = RecursiveHDLDelete(data.id, dir_name)
+                task_id = SchedulePurge(PROJECT_ID=data.id, TRASH=[trash] if trash else [])
             except Exception as e:
                 print(e)
+                db.session.rollback()
                 return "Error: deletion aborted", 500
             else:
-                return "Success: deletion done", 200
+                return make_response(jsonify({'status': "Success: deletion scheduled", 'task_id': task_id}), 202)
 
 
 # HDL_file Table manager
@@ -381,13 +821,9 @@ class manage_HDL_file(Resource):
             id = None
 
         if not id:
-            data = HDL_file.query.all()
-            if not data:
-                return "Error: No HDL files in table", 404
-            data_schema = HDL_fileSchema(many=True)
-            return jsonify(data_schema.dump(data))
+            return ListRows(HDL_file, HDL_fileSchema, {'Project_id': int, 'top_level_flag': ArgBool, 'file_name': str}, "Error: No HDL files in table")
         else:
-            data = HDL_file.query.get(id)
+            data = Live(HDL_file).filter(HDL_file.id == id).first()
             if not data:
                 return "Error: HDL file doesn't exist", 404
             data_schema = HDL_fileSchema()
@@ -403,39 +839,57 @@ class manage_HDL_file(Resource):
         # fetch json data
         Project_id = json_data['Project_id']
         top_level_flag = json_data['top_level_flag']
+        # content already in the blob store can be referenced without sending
+        # it, a sent file is hashed instead since the client hash is unchecked
+        content_hash = json_data.get('sha256') if hdl is None else None
+        file_name = hdl.filename if hdl else json_data.get('file_name')
+        if not file_name:
+            return "Error: No file to upload", 400
+        if hdl is None and not (content_hash and blobs.has(content_hash)):
+            return "Error: unknown content, send the file", 412
 
         # check project existance
-        project_data = Project.query.get(Project_id)
+        project_data = GetProject(Project_id)
         if project_data is None:
             return "Error: The project doesn't exist", 412
 
-        # check if HDL it exists
-        check = HDL_file.query.filter_by(Project_id=Project_id, file_name=hdl.filename).first()
+        # check if HDL it exists, resending the same content is a no-op
+        check = Live(HDL_file).filter_by(Project_id=Project_id, file_name=file_name).first()
         if check:
+            if check.content_hash and (content_hash or blobs.digest(hdl.stream)) == check.content_hash:
+                return "Success: content unchanged", 200, {'ETag': '"' + check.content_hash + '"'}
             return "Error: HDL file already exists", 400
 
         # check if Top level entity is there
         if top_level_flag:
-            check = HDL_file.query.filter_by(Project_id=Project_id, top_level_flag=True).first()
+            check = Live(HDL_file).filter_by(Project_id=Project_id, top_level_flag=True).first()
             if check:
                 return "Error: Top level entity already exists", 400
 
         # finding folder name for proj
-        Curr = os.getcwd()
-        fpga_data = FPGA.query.get(project_data.FPGA_id)
-        dir_name = os.path.join(Curr, project_data.Project_name + "_" + fpga_data.model_id + "/")
+        dir_name = ProjectDir(project_data) + "/"
 
-        # assemble record
-        data = HDL_file(Project_id, hdl.filename, top_level_flag)
+        dropped = set()
         try:
-            hdl.save(dir_name + hdl.filename)
+            dropped = DropTombstoned(Project_id, [file_name])
+            # referenced content is linked without writing any bytes
+            if hdl is not None:
+                content_hash, _ = blobs.ingest(hdl.stream)
+            blobs.link(content_hash, dir_name + file_name)
+            # assemble record
+            data = HDL_file(Project_id, file_name, top_level_flag, content_hash)
             db.session.add(data)
             db.session.commit()
+            CollectBlobs(dropped)
+            IndexScan(content_hash, file_name)
         except Exception as e:
             print(e)
+            db.session.rollback()
+            if content_hash:
+                CollectBlobs([content_hash])
             return "Error: insertion aborted", 500
         else:
-            return "Success: insertion done", 201
+            return "Success: insertion done", 201, {'ETag': '"' + content_hash + '"'}
 
     # UPDATE HDL_file
     @staticmethod
@@ -449,7 +903,7 @@ class manage_HDL_file(Resource):
             return "Error: No ID for UPDATE", 400
         else:
             try:
-                data = HDL_file.query.get(id)
+                data = GetHDL(id)
 
                 # check if HDL file is on record
                 if data is None:
@@ -462,31 +916,57 @@ class manage_HDL_file(Resource):
                 # fetch json data
                 Project_id = json_data['Project_id']
                 top_level_flag = json_data['top_level_flag']
+                file_name = hdl.filename if hdl else json_data.get('file_name', data.file_name)
+
+                # If-Match carries the hash of the content the client would send,
+                # a sent file is hashed instead since the client hash is unchecked
+                if_match = request.headers.get('If-Match', '').strip('"') or json_data.get('sha256')
+                old_hash = data.content_hash
+                new_hash = None
+                if hdl is None:
+                    if if_match and if_match != old_hash:
+                        return "Error: content changed, send the file", 412
+                    # metadata only update
+                    unchanged = True
+                else:
+                    new_hash, _ = blobs.ingest(hdl.stream)
+                    unchanged = new_hash == old_hash
 
                 # get old file path
-                Curr = os.getcwd()
-                project_data_src = Project.query.get(data.Project_id)
-                fpga_data_src = FPGA.query.get(project_data_src.FPGA_id)
-                file_path_src = os.path.join(Curr, project_data_src.Project_name + "_" + fpga_data_src.model_id + "/" + data.file_name)
+                file_path_src = os.path.join(ProjectDir(data.project), data.file_name)
                 # get new dir name
-                project_data_dst = Project.query.get(Project_id)
-                fpga_data_dst = FPGA.query.get(project_data_dst.FPGA_id)
-                file_path_dst = os.path.join(Curr, project_data_dst.Project_name + "_" + fpga_data_dst.model_id + "/" + hdl.filename)
+                project_data_dst = data.project if data.Project_id == int(Project_id) else GetProject(Project_id)
+                file_path_dst = os.path.join(ProjectDir(project_data_dst), file_name)
 
                 # Update file name
-                os.rename(file_path_src, file_path_dst)
+                if file_path_src != file_path_dst:
+                    os.rename(file_path_src, file_path_dst)
+                # Update content
+                if not unchanged:
+                    blobs.link(new_hash, file_path_dst)
+                    data.content_hash = new_hash
 
                 # update row
                 data.Project_id = Project_id
-                data.file_name = hdl.filename
+                data.project = project_data_dst
+                data.file_name = file_name
                 data.top_level_flag = top_level_flag
 
                 db.session.commit()
+                if not unchanged and old_hash:
+                    CollectBlobs([old_hash])
+                # a rename may turn the file into a verilog source
+                if data.content_hash:
+                    IndexScan(data.content_hash, file_name)
             except Exception as e:
                 print(e)
+                db.session.rollback()
                 return "Error: update aborted", 500
             else:
-                return "Succes: update done", 200
+                headers = {'ETag': '"' + data.content_hash + '"'} if data.content_hash else {}
+                if unchanged:
+                    return "Success: content unchanged", 200, headers
+                return "Succes: update done", 200, headers
 
     # DELETE HDL_file
     @staticmethod
@@ -500,26 +980,136 @@ class manage_HDL_file(Resource):
             return "Error: No ID for DELETE", 400
         else:
             try:
-                data = HDL_file.query.get(id)
+                data = GetHDL(id)
 
                 # check if HDL file is on record
                 if data is None:
                     return "Error: HDL file doesn't exist", 412
 
                 # finding file name for HDL
-                Curr = os.getcwd()
-                project_data = Project.query.get(data.Project_id)
-                fpga_data = FPGA.query.get(project_data.FPGA_id)
-                file_path = os.path.join(Curr, project_data.Project_name + "_" + fpga_data.model_id + "/" + data.file_name)
+                file_path = os.path.join(ProjectDir(data.project), data.file_name)
 
-                os.remove(file_path)
-                db.session.delete(data)
+                # hide the file at once, the row and its blob go in the background
+                data.deleted_at = datetime.datetime.utcnow()
                 db.session.commit()
+                trash = Trash(file_path)
+                task_id = SchedulePurge(FILE_IDS=[data.id], TRASH=[trash] if trash else [])
             except Exception as e:
                 print(e)
+                db.session.rollback()
                 return "Error: deletion aborted", 500
             else:
-                return "Success: deletion done", 200
+                return make_response(jsonify({'status': "Success: deletion scheduled", 'task_id': task_id}), 202)
+
+
+# extract an uploaded archive into dst_dir, returning the file names
+def ExtractArchive(archive, dst_dir):
+    names = []
+    name = archive.filename.lower()
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(archive.stream) as zf:
+            for member in zf.infolist():
+                if member.is_dir():
+                    continue
+                names.append(StoreMember(zf.open(member), member.filename, dst_dir))
+    else:
+        # tar archives are read as a stream, compression is detected
+        with tarfile.open(fileobj=archive.stream, mode="r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                names.append(StoreMember(tf.extractfile(member), member.name, dst_dir))
+    return names
+
+
+# copy one archive member into dst_dir, projects keep a flat layout
+def StoreMember(src, member_name, dst_dir):
+    file_name = os.path.basename(member_name)
+    if not file_name or file_name.startswith("."):
+        raise ValueError("invalid file name in archive: " + member_name)
+    dst = os.path.join(dst_dir, file_name)
+    if os.path.exists(dst):
+        raise ValueError("duplicate file name in archive: " + file_name)
+    with open(dst, "wb") as f:
+        shutil.copyfileobj(src, f, 1 << 16)
+    return file_name
+
+
+# HDL_file bulk upload
+class manage_HDL_bulk(Resource):
+    # INSERT many HDL_files, as several files or one tar/zip archive
+    @staticmethod
+    def post():
+        # fetch data from request, uploads are spooled to disk by the form parser
+        hdls = request.files.getlist('file')
+        archive = request.files.get('archive')
+        json_data = json.loads(request.form['json'])
+
+        # fetch json data
+        Project_id = json_data['Project_id']
+        top_level_file = json_data.get('top_level_file')
+
+        if not hdls and archive is None:
+            return "Error: No files to upload", 400
+
+        # check project existance
+        project_data = GetProject(Project_id)
+        if project_data is None:
+            return "Error: The project doesn't exist", 412
+
+        # finding folder name for proj
+        dir_name = ProjectDir(project_data)
+
+        # stage the upload next to the project files
+        staging = tempfile.mkdtemp(prefix=".upload-", dir=dir_name)
+        try:
+            try:
+                if archive is not None:
+                    names = ExtractArchive(archive, staging)
+                else:
+                    names = [StoreMember(hdl.stream, hdl.filename, staging) for hdl in hdls]
+            except (ValueError, tarfile.TarError, zipfile.BadZipFile) as e:
+                return "Error: " + str(e), 400
+            if not names:
+                return "Error: No files to upload", 400
+
+            # set based checks against the records of the project
+            existing = Live(HDL_file).filter(HDL_file.Project_id == Project_id, HDL_file.file_name.in_(names)).all()
+            if existing:
+                return "Error: HDL files already exist: " + ", ".join(sorted(h.file_name for h in existing)), 400
+            if top_level_file:
+                if top_level_file not in names:
+                    return "Error: Top level file not in upload", 400
+                check = Live(HDL_file).filter_by(Project_id=Project_id, top_level_flag=True).first()
+                if check:
+                    return "Error: Top level entity already exists", 400
+
+            # move the files into the blob store, link them in place and insert every record in one transaction
+            moved = []
+            dropped = set()
+            try:
+                hashes = {}
+                dropped = DropTombstoned(Project_id, names)
+                for name in names:
+                    hashes[name], _ = blobs.adopt(os.path.join(staging, name))
+                    blobs.link(hashes[name], os.path.join(dir_name, name))
+                    moved.append(name)
+                db.session.add_all([HDL_file(Project_id, name, name == top_level_file, hashes[name]) for name in names])
+                db.session.commit()
+                CollectBlobs(dropped)
+                for name in names:
+                    IndexScan(hashes[name], name)
+            except Exception as e:
+                print(e)
+                db.session.rollback()
+                for name in moved:
+                    os.remove(os.path.join(dir_name, name))
+                CollectBlobs(hashes.values())
+                return "Error: insertion aborted", 500
+            else:
+                return make_response(jsonify({'inserted': len(names), 'files': names}), 201)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
 
 
 # SymbiflowRunner
@@ -528,11 +1118,19 @@ class run_toolchain(Resource):
     def get():
         try:
             process_id = request.args.get('id')
-            task_result = RunSymbiFlow.AsyncResult(process_id)
+            # long poll: block until the state differs from the known one
+            wait = min(float(request.args.get('wait', 0)), MAX_STATUS_WAIT)
+            known = request.args.get('state')
+            if wait > 0:
+                def changed():
+                    status = TaskStatus(process_id)[0]
+                    return status != known if known else status in states.READY_STATES
+                WaitStatus(rdb, process_id, wait, changed)
+            task_status, task_result = TaskStatus(process_id)
             result = {
                 'task_id': process_id,
-                'task_status': task_result.status,
-                'task_result': task_result.result
+                'task_status': task_status,
+                'task_result': task_result
             }
             return make_response(jsonify(result), 200)
         except Exception as e:
@@ -545,7 +1143,16 @@ class run_toolchain(Resource):
         id = request.json['id']
         mode = request.json['mode']
         toolchain = request.json['toolchain']
-
+        priority = request.json.get('priority', DEFAULT_PRIORITY)
+        skip_unchanged = request.json.get('skip_unchanged', False)
+        # flash a board once the bitstream is there
+        program = request.json.get('program', False)
+        # check the verilog hierarchy before enqueueing, "strict" also rejects unknown modules
+        preflight = request.json.get('preflight', True)
+
+        # check if priority class is known
+        if priority not in PRIORITIES:
+            return "Error: unknown priority class", 400
         # check if id is present
         if not id:
             return "Error: No ID for Project", 400
@@ -555,17 +1162,313 @@ class run_toolchain(Resource):
                 print("No mode specified: Defaulting to 2")
                 mode = 2
             # check if project data is present
-            data = Project.query.get(id)
+            data = GetProject(id)
             if not data:
                 return "Error: The Project doesn't exist", 412
             # toolchain selector
             if (toolchain == "symbiflow"):
-                process_id = SymbiflowHelper(data, mode)
+                top_level = Live(HDL_file).filter_by(Project_id=data.id, top_level_flag=True).first()
+                if top_level is None:
+                    return "Error: No top level file", 412
+                # broken hierarchies are rejected before any container starts
+                sources = warning = None
+                if preflight:
+                    try:
+                        error, sources, warning = Preflight(data, top_level)
+                    except Exception as e:
+                        print(e)
+                        error = None
+                    if error:
+                        return error, 412
+                    if warning and preflight == "strict":
+                        return "Error: " + warning, 412
+                # nothing changed since the last good build
+                fingerprint = ProjectFingerprint(data.id) if skip_unchanged else None
+                build = UnchangedBuild(data.id, data.fpga.model_id, mode,
+                                       BuildFingerprint(fingerprint, data.fpga.model_id, top_level.file_name)) \
+                    if fingerprint else None
+                if build:
+                    process_id, code = build.task_id, 200
+                else:
+                    process_id, code = SymbiflowHelper(data, top_level, mode, priority, sources), 202
             else:
                 return "Error: no toolchain selected", 400
 
+            # programming waits for the build on its own queue
+            if program:
+                program_id = ProgramBoard.apply_async(kwargs=dict(BUILD_TASK_ID=process_id, PART_NAME=data.fpga.model_id,
+                                                                  TOP_FILE=top_level.file_name,
+                                                                  PROJECT_ID=data.id, ENQUEUED_AT=time.time()),
+                                                      priority=PriorityFor(priority)).id
+                response = make_response(jsonify({'task_id': process_id, 'program_task_id': program_id}), 202)
+                if warning:
+                    response.headers['X-Preflight-Warning'] = warning
+                return response
+
             #return the process id for later check
-            return process_id, 202
+            return process_id, code, {'X-Preflight-Warning': warning} if warning else {}
+
+    # CANCEL a queued or running build
+    @staticmethod
+    def delete():
+        process_id = request.args.get('id')
+        if not process_id:
+            return "Error: No ID for DELETE", 400
+        build = Build.query.filter_by(task_id=process_id).first()
+        if build is not None and build.finished_at is not None:
+            return "Error: build already finished", 409
+        try:
+            # a running build is stopped by the watchdog of its worker
+            RequestCancel(rdb, process_id, CANCELLED)
+            # queued messages are dropped when a worker receives them
+            celery_app.control.revoke(process_id)
+            if build is not None and build.started_at is None:
+                # never started, nothing on a worker will close it
+                build.status = states.REVOKED
+                build.exit_status = 1
+                build.finished_at = datetime.datetime.utcnow()
+                db.session.commit()
+                inflight_key = INFLIGHT_PREFIX + str(build.Project_id) + ":" + str(build.source_hash) + ":" + str(build.mode)
+                ReleaseInflight(inflight_key, process_id)
+                PublishStatus(rdb, process_id, states.REVOKED)
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return "Error: cancel aborted", 500
+        else:
+            return "Success: cancel requested", 202
+
+
+# Batch SymbiflowRunner
+class run_toolchain_batch(Resource):
+    @staticmethod
+    def get():
+        try:
+            batch_id = request.args['id']
+        except Exception as e:
+            return "Error: no id for batch status", 400
+
+        # the stored members and the build history outlive the result backend
+        members = rdb.get(BATCH_PREFIX + batch_id)
+        if members is None:
+            return "Error: The batch doesn't exist", 404
+        members = json.loads(members)
+
+        # aggregate the member states, reporting partial results
+        counts = {}
+        tasks = []
+        completed = 0
+        failed = 0
+        # one history query for the whole batch
+        builds = {b.task_id: b for b in Build.query.filter(Build.task_id.in_([m['task_id'] for m in members if m.get('task_id')])).all()}
+        for member in members:
+            # projects rejected at submission count as failed
+            if member.get('task_id') is None:
+                completed += 1
+                failed += 1
+                tasks.append(member)
+                continue
+            build = builds.get(member['task_id'])
+            if build is not None:
+                status, result = BuildStatus(build)
+            else:
+                task_result = RunSymbiFlow.AsyncResult(member['task_id'])
+                status, result = task_result.status, task_result.result
+            counts[status] = counts.get(status, 0) + 1
+            ready = status in states.READY_STATES
+            if ready:
+                completed += 1
+                # RunSymbiFlow returns True when the build failed
+                if status != states.SUCCESS or result is True:
+                    failed += 1
+            tasks.append(dict(member, task_status=status, task_result=result if ready else None))
+        if completed < len(members):
+            batch_status = states.PENDING if counts.get(states.PENDING, 0) == len(members) else states.STARTED
+        elif failed == 0:
+            batch_status = states.SUCCESS
+        else:
+            batch_status = states.FAILURE if failed == len(members) else "PARTIAL"
+        result = {
+            'batch_id': batch_id,
+            'batch_status': batch_status,
+            'total': len(members),
+            'completed': completed,
+            'failed': failed,
+            'counts': counts,
+            'tasks': tasks
+        }
+        return make_response(jsonify(result), 200)
+
+    @staticmethod
+    def post():
+        # get request payload
+        ids = request.json.get('ids')
+        Project_name = request.json.get('Project_name')
+        FPGA_ids = request.json.get('FPGA_ids')
+        mode = request.json['mode']
+        toolchain = request.json['toolchain']
+        # sweeps run in the background class unless asked otherwise
+        priority = request.json.get('priority', "ci")
+        preflight = request.json.get('preflight', True)
+
+        if toolchain != "symbiflow":
+            return "Error: no toolchain selected", 400
+        if priority not in PRIORITIES:
+            return "Error: unknown priority class", 400
+        # check if mode is correct
+        if (mode != 0 and mode != 1):
+            print("No mode specified: Defaulting to 2")
+            mode = 2
+
+        # gather every project in one query
+        if ids:
+            projects = Live(Project).filter(Project.id.in_(ids)).all()
+        elif Project_name and FPGA_ids:
+            projects = Live(Project).filter(Project.Project_name == Project_name, Project.FPGA_id.in_(FPGA_ids)).all()
+        else:
+            return "Error: No IDs for batch", 400
+        if not projects:
+            return "Error: The Projects don't exist", 412
+
+        # fetch FPGAs and top level files for all projects at once
+        project_ids = [p.id for p in projects]
+        fpgas = {f.id: f for f in FPGA.query.filter(FPGA.id.in_({p.FPGA_id for p in projects})).all()}
+        tops = {h.Project_id: h for h in Live(HDL_file).filter(HDL_file.Project_id.in_(project_ids), HDL_file.top_level_flag == True).all()}
+
+        members = []
+        signatures = []
+        found = {p.id for p in projects}
+        for missing in (ids or []):
+            if int(missing) not in found:
+                members.append({'project_id': missing, 'task_id': None, 'error': "The Project doesn't exist"})
+        try:
+            for project in projects:
+                if project.id not in tops:
+                    members.append({'project_id': project.id, 'task_id': None, 'error': "No top level file"})
+                    continue
+                sources = warning = None
+                if preflight:
+                    try:
+                        error, sources, warning = Preflight(project, tops[project.id])
+                    except Exception as e:
+                        print(e)
+                        error = None
+                    if warning and preflight == "strict":
+                        error = "Error: " + warning
+                    if error:
+                        members.append({'project_id': project.id, 'task_id': None, 'error': error[len("Error: "):]})
+                        continue
+                task_id, sig = SymbiflowSignature(project, fpgas[project.FPGA_id], tops[project.id], mode, priority,
+                                                  sources)
+                member = {'project_id': project.id, 'task_id': task_id}
+                if warning:
+                    member['warning'] = warning
+                members.append(member)
+                if sig is not None:
+                    signatures.append(sig)
+
+            # enqueue the new builds as one group, coalesced builds join the handle
+            db.session.commit()
+            if signatures:
+                group(signatures).apply_async()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            # in-flight keys taken so far point at builds that will never run
+            new_ids = [sig.options['task_id'] for sig in signatures]
+            for sig in signatures:
+                ReleaseInflight(sig.kwargs['INFLIGHT_KEY'], sig.options['task_id'])
+            Build.query.filter(Build.task_id.in_(new_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            return "Error: batch enqueue aborted", 500
+        batch_id = str(uuid.uuid4())
+        rdb.set(BATCH_PREFIX + batch_id, json.dumps(members), ex=BATCH_TTL)
+
+        #return the batch id for later check
+        return make_response(jsonify({'batch_id': batch_id, 'tasks': members}), 202)
+
+
+# Task status transitions as Server-Sent Events
+class build_events(Resource):
+    @staticmethod
+    def get(id):
+        def events():
+            for event in FollowStatus(rdb, id):
+                # on subscribe and keepalive report the stored state
+                if event is None:
+                    task_status = TaskStatus(id)[0]
+                    # no connection is held between keepalives
+                    db.session.close()
+                    event = {'task_id': id, 'task_status': task_status}
+                    if task_status in states.READY_STATES:
+                        yield "data: " + json.dumps(event) + "\n\n"
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield "data: " + json.dumps(event) + "\n\n"
+                if event['task_status'] in states.READY_STATES:
+                    return
+
+        # the status lookups query the database after the view returned
+        return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Live build log as Server-Sent Events
+class build_log(Resource):
+    @staticmethod
+    def get(id):
+        # resume after the last event the client has seen
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('offset') or "0"
+
+        # the redis stream expired, the archived log of a remote build is still in the store
+        if store is not None and not rdb.exists(LogKey(id)) and store.has(BuildLogKey(id)):
+            return Response(store.read(BuildLogKey(id)), mimetype='text/plain')
+
+        def events():
+            for entry in FollowLog(rdb, id, last_id):
+                if entry is None:
+                    # keepalive, and give up on tasks that ended without a log
+                    ready = TaskStatus(id)[0] in states.READY_STATES
+                    db.session.close()
+                    if ready and not rdb.exists(LogKey(id)):
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                entry_id, line = entry
+                yield "id: " + entry_id + "\ndata: " + line + "\n\n"
+            yield "event: end\ndata: \n\n"
+
+        # the status lookups query the database after the view returned
+        return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def FileChunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            yield chunk
+
+
+# stream chunks gzip compressed, honouring If-None-Match
+def SendCompressed(source, filename, etag):
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    def chunks():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in source:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    response = Response(chunks(), mimetype='application/octet-stream')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Disposition'] = 'inline; filename=' + filename
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    return response
 
 
 class retrieve_bitstream(Resource):
@@ -577,20 +1480,186 @@ class retrieve_bitstream(Resource):
             return "Error: No project ID", 400
 
         try:
-            Curr = os.getcwd()
-            prj_data = Project.query.get(id)
+            prj_data = GetProject(id)
             if not prj_data:
                 return "Error: The Project doesn't exist", 412
-            fpga_data = FPGA.query.get(prj_data.FPGA_id)
-            bitstream_path = os.path.join(Curr, prj_data.Project_name + "_" + fpga_data.model_id + "/build/symbiflow.bit")
+            fpga_data = prj_data.fpga
+            filename = prj_data.Project_name + "_" + fpga_data.model_id
+            bitstream_path = os.path.join(ProjectDir(prj_data), "build/symbiflow.bit")
             if os.path.isfile(bitstream_path):
-                filename = prj_data.Project_name + "_" + fpga_data.model_id
-                return send_file(bitstream_path, attachment_filename=filename)
+                # strong validator from the content hash stored with the build
+                etag = BitstreamHash(ProjectDir(prj_data))
+                # whole downloads can be compressed on the fly
+                if 'gzip' in request.accept_encodings and request.range is None:
+                    return SendCompressed(FileChunks(bitstream_path), filename, etag + "-gzip")
+                # send_file answers If-None-Match/If-Modified-Since with 304 and serves Range requests
+                return send_file(bitstream_path, download_name=filename, conditional=True, etag=etag)
+            # built on another host or build dir reused, the archive has the last good bitstream
+            build = Build.query.filter_by(Project_id=prj_data.id, status=states.SUCCESS, exit_status=0) \
+                .filter(Build.artifact_hash.isnot(None), Build.pruned_at.is_(None)).order_by(Build.id.desc()).first()
+            if build and FetchArtifact(build.artifact_hash):
+                return SendArtifact(build.artifact_hash, filename, build.artifact_size)
             else:
                 return "Error: bitsream file does not exist", 412
         except Exception as e:
             return str(e), 500
 
+# Build history
+class build_history(Resource):
+    @staticmethod
+    def get():
+        try:
+            id = request.args['id']
+        except Exception as e:
+            id = None
+
+        if not id:
+            return ListRows(Build, BuildSchema, {'Project_id': int, 'part': str, 'mode': int, 'status': str,
+                                                 'source_hash': str, 'task_id': str, 'artifact_hash': str},
+                            "Error: No builds in table")
+        else:
+            data = Build.query.get(id)
+            if not data:
+                return "Error: The build doesn't exist", 404
+            data_schema = BuildSchema()
+            return jsonify(data_schema.dump(data))
+
+
+# Source fingerprint of a project
+class project_fingerprint(Resource):
+    @staticmethod
+    def get():
+        try:
+            id = int(request.args['id'])
+        except Exception as e:
+            return "Error: No ID for Project", 400
+        if not GetProject(id):
+            return "Error: The Project doesn't exist", 404
+        fingerprint = ProjectFingerprint(id)
+        if not fingerprint:
+            return "Error: project files have no content hash", 412
+        return make_response(jsonify({'Project_id': id, 'fingerprint': fingerprint}), 200, {'ETag': '"' + fingerprint + '"'})
+
+
+# stream an archived bitstream, decompressing it on the way out
+def SendArtifact(artifact_hash, filename, size=None):
+    if 'gzip' in request.accept_encodings:
+        return SendCompressed(ArtifactChunks(artifact_hash), filename, artifact_hash + "-gzip")
+    if artifact_hash in request.if_none_match:
+        response = make_response("", 304)
+        response.set_etag(artifact_hash)
+        return response
+    response = Response(ArtifactChunks(artifact_hash), mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename=' + filename
+    if size:
+        response.headers['Content-Length'] = str(size)
+    response.set_etag(artifact_hash)
+    return response
+
+
+# Disk usage per project
+class project_usage(Resource):
+    @staticmethod
+    def get():
+        id = request.args.get('id')
+        if id:
+            projects = [GetProject(id)]
+            if projects[0] is None:
+                return "Error: The Project doesn't exist", 404
+        else:
+            projects = Live(Project).options(joinedload(Project.fpga)).all()
+        # bitstreams still kept by each project, in one query
+        kept = {}
+        rows = db.session.query(Build.Project_id, Build.artifact_hash) \
+            .filter(Build.Project_id.in_([p.id for p in projects]), Build.artifact_hash.isnot(None),
+                    Build.pruned_at.is_(None)).distinct()
+        for project_id, artifact_hash in rows:
+            kept.setdefault(project_id, set()).add(artifact_hash)
+
+        usage = []
+        for project in projects:
+            prj_dir = ProjectDir(project)
+            build = DirSize(os.path.join(prj_dir, BUILD_DIR))
+            # sources are hardlinks into the blob store, shared with other projects
+            sources = DirSize(prj_dir) - build
+            hashes = kept.get(project.id, set())
+            artifacts = sum(os.path.getsize(ArtifactPath(h)) for h in hashes if os.path.isfile(ArtifactPath(h)))
+            usage.append({'Project_id': project.id, 'Project_name': project.Project_name, 'sources': sources,
+                          'build': build, 'artifacts': artifacts, 'bitstreams': len(hashes),
+                          'total': sources + build + artifacts})
+        return make_response(jsonify(usage[0] if id else usage), 200)
+
+
+# Bitstream of a past build
+class build_bitstream(Resource):
+    @staticmethod
+    def get(id):
+        data = Build.query.get(id)
+        if not data:
+            return "Error: The build doesn't exist", 404
+        # the store copy may outlive retention for a moment, it is not served
+        if data.pruned_at is not None:
+            return "Error: bitstream removed by retention", 410
+        if not data.artifact_hash or not FetchArtifact(data.artifact_hash):
+            return "Error: bitsream file does not exist", 412
+        filename = "build_" + str(data.id) + "_" + (data.part or "")
+        return SendArtifact(data.artifact_hash, filename, data.artifact_size)
+
+
+# Boards available for programming
+class devices(Resource):
+    @staticmethod
+    def get():
+        try:
+            boards = registry.all()
+        except Exception as e:
+            print(e)
+            return "Error: device registry unavailable", 503
+        model_id = request.args.get('model_id')
+        if model_id:
+            boards = [b for b in boards if b['model_id'] == model_id]
+        return make_response(jsonify(boards), 200)
+
+
+# Prometheus metrics
+class metrics(Resource):
+    @staticmethod
+    def get():
+        data, content_type = Exposition(metrics_registry)
+        return Response(data, mimetype=content_type)
+
+
+# Profile store admin
+class admin_profiles(Resource):
+    @staticmethod
+    def get(id=None):
+        # profiles hold request paths and every sql statement
+        if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+            return "Error: admin token required", 403
+        if id is None:
+            return make_response(jsonify(profiles.list()), 200)
+        # raw pstats dump for snakeviz/pstats
+        if request.args.get('format') == 'pstats':
+            path = profiles.raw_path(id)
+            if path is None:
+                return "Error: The profile doesn't exist", 404
+            return send_file(path, download_name=id + ".prof")
+        data = profiles.get(id)
+        if data is None:
+            return "Error: The profile doesn't exist", 404
+        return make_response(jsonify(data), 200)
+
+
+# Build cache statistics
+class cache_stats(Resource):
+    @staticmethod
+    def get():
+        try:
+            return make_response(jsonify(cache.stats()), 200)
+        except Exception as e:
+            print(e)
+            return "Error: cache statistics unavailable", 500
+
 """
 class clean_test(Resource):
 
@@ -605,11 +1674,26 @@ class clean_test(Resource):
 # Setting website resources
 api.add_resource(manage_fpga, '/fpga')
 api.add_resource(manage_project, '/project')
+api.add_resource(project_fingerprint, '/project/fingerprint')
+api.add_resource(project_usage, '/project/usage')
 api.add_resource(manage_HDL_file, '/file')
+api.add_resource(manage_HDL_bulk, '/file/bulk')
 api.add_resource(run_toolchain, '/toolchain')
+api.add_resource(run_toolchain_batch, '/toolchain/batch')
+api.add_resource(build_log, '/toolchain/<string:id>/log')
+api.add_resource(build_events, '/toolchain/<string:id>/events')
 api.add_resource(retrieve_bitstream, '/bitstream')
+api.add_resource(build_history, '/build')
+api.add_resource(build_bitstream, '/build/<int:id>/bitstream')
+api.add_resource(cache_stats, '/cache')
+api.add_resource(devices, '/devices')
+api.add_resource(metrics, '/metrics')
+api.add_resource(admin_profiles, '/admin/profiles', '/admin/profiles/<string:id>')
 # api.add_resource(clean_test, '/clean')
+# metrics of this process, worker processes and the broker queues
+metrics_registry = MakeRegistry(QueueCollector(redis.Redis.from_url(celery_app.conf.broker_url)), CacheCollector(cache))
 
 if __name__ == '__main__':
-    checkdatabase()
+    with app.app_context():
+        checkdatabase()
     app.run(host='0.0.0.0',debug=True)
@@ -0,0 +1,154 @@
+import os, shutil, tarfile, tempfile
+from urllib.parse import urlparse
+
+# store shared by the api and the build nodes, file:///path or s3://bucket/prefix,
+# empty keeps every build on the api host
+STORE_URL = os.environ.get("SYMBIFLASK_STORE_URL", "")
+# endpoint of an s3 compatible server such as minio
+S3_ENDPOINT = os.environ.get("SYMBIFLASK_S3_ENDPOINT")
+# local copies of the projects built on a node
+SCRATCH_DIR = os.environ.get("SYMBIFLASK_SCRATCH_DIR", os.path.join(os.getcwd(), "scratch"))
+
+
+def BundleKey(source_hash):
+    return "bundles/" + source_hash + ".tar.gz"
+
+
+def ArtifactKey(artifact_hash):
+    return "artifacts/" + artifact_hash[:2] + "/" + artifact_hash + ".bit.zst"
+
+
+def BuildLogKey(task_id):
+    return "logs/" + task_id + ".log"
+
+
+# objects on a shared filesystem (nfs, cephfs, ...)
+class FileStore:
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def has(self, key):
+        return os.path.isfile(self._path(key))
+
+    # copies are renamed in place so readers never see a partial object
+    def put(self, key, path):
+        dst = self._path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = dst + "." + str(os.getpid()) + ".tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dst)
+
+    def get(self, key, path):
+        tmp = path + ".tmp"
+        shutil.copyfile(self._path(key), tmp)
+        os.replace(tmp, path)
+
+    def read(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+# objects in an s3 compatible bucket, boto3 is only needed when it is used
+class S3Store:
+
+    def __init__(self, bucket, prefix="", endpoint=S3_ENDPOINT):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client = boto3.client("s3", endpoint_url=endpoint)
+        self.ClientError = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key):
+        return self.prefix + "/" + key if self.prefix else key
+
+    def has(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self.ClientError:
+            return False
+
+    def put(self, key, path):
+        self.client.upload_file(path, self.bucket, self._key(key))
+
+    def get(self, key, path):
+        tmp = path + ".tmp"
+        self.client.download_file(self.bucket, self._key(key), tmp)
+        os.replace(tmp, path)
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+# store configured for this process, None without one
+def MakeStore(url=STORE_URL):
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return FileStore(parsed.path)
+    if parsed.scheme == "s3":
+        return S3Store(parsed.netloc, parsed.path)
+    raise ValueError("unknown store: " + url)
+
+
+# pack the flat source files of a project dir, once per content
+def PushSources(store, prj_dir, source_hash):
+    key = BundleKey(source_hash)
+    if store.has(key):
+        return key
+    fd, tmp = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(fd)
+    try:
+        with tarfile.open(tmp, "w:gz") as tf:
+            for name in sorted(os.listdir(prj_dir)):
+                path = os.path.join(prj_dir, name)
+                # same selection as HashSources
+                if name.startswith(".") or not os.path.isfile(path):
+                    continue
+                tf.add(path, arcname=name)
+        store.put(key, tmp)
+    finally:
+        os.remove(tmp)
+    return key
+
+
+# unpack a bundle into a scratch dir, build/ is kept so unchanged stages are skipped
+def FetchSources(store, key, scratch_dir):
+    os.makedirs(scratch_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".tar.gz", dir=scratch_dir, prefix=".bundle-")
+    os.close(fd)
+    try:
+        store.get(key, tmp)
+        with tarfile.open(tmp, "r:gz") as tf:
+            members = [m for m in tf.getmembers()
+                       if m.isfile() and "/" not in m.name and not m.name.startswith(".")]
+            names = {m.name for m in members}
+            # sources deleted from the project since the last build here
+            for name in os.listdir(scratch_dir):
+                path = os.path.join(scratch_dir, name)
+                if not name.startswith(".") and os.path.isfile(path) and name not in names:
+                    os.remove(path)
+            for member in members:
+                tmp_member = os.path.join(scratch_dir, "." + member.name + ".tmp")
+                with tf.extractfile(member) as src, open(tmp_member, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(tmp_member, os.path.join(scratch_dir, member.name))
+    finally:
+        os.remove(tmp)
+    return scratch_dir
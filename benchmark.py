@@ -0,0 +1,304 @@
+# Load and benchmark harness for the REST API and the build pipeline.
+#
+# Runs the Flask app in-process with Celery in eager mode and the local
+# fake toolchain executor, so no docker image is needed (a local Redis is).
+#
+#   python benchmark.py --requests 2000 --concurrency 8
+#   python benchmark.py --mix status_poll=5,bitstream=2 --compare bench_results/<old>.json
+import os, sys, io, json, time, random, argparse, tempfile, threading, datetime
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ["fpga_create", "project_create", "hdl_upload", "status_poll", "bitstream", "list_files", "build"]
+DEFAULT_MIX = "fpga_create=1,project_create=1,hdl_upload=3,status_poll=6,bitstream=3,list_files=2,build=1"
+UPLOAD_SIZES = (1 << 10, 1 << 16, 1 << 20)
+
+# fake toolchain: writes the outputs of the requested stage
+FAKE_TOOLCHAIN = """import os, sys
+stage = os.environ["STAGE"]
+top = os.path.splitext(os.environ["TOP_FILE"])[0]
+os.makedirs("build", exist_ok=True)
+ext = {"synth": [".eblif"], "pack": [".net"], "place": [".place"], "route": [".route"], "bitstream": [".fasm"]}[stage]
+for e in ext:
+    with open(os.path.join("build", top + e), "w") as f:
+        f.write(stage + " of " + top)
+if stage == "bitstream":
+    with open(os.path.join("build", "symbiflow.bit"), "wb") as f:
+        f.write(os.urandom(int(os.environ.get("FAKE_BITSTREAM_SIZE", 1 << 20))))
+print(stage + " done")
+"""
+
+
+def Percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# environment of the app under test, set before it is imported
+def PrepareEnvironment(workdir, bitstream_size, concurrency):
+    script = os.path.join(workdir, "fake_toolchain.py")
+    with open(script, "w") as f:
+        f.write(FAKE_TOOLCHAIN)
+    os.environ.setdefault("SYMBIFLASK_DATABASE_URI", "sqlite:///" + os.path.join(workdir, "bench.db"))
+    os.environ["SYMBIFLASK_EXECUTOR"] = "local"
+    os.environ["SYMBIFLASK_LOCAL_CMD"] = sys.executable + " " + script
+    # the fake toolchain runs one stage per call
+    os.environ["SYMBIFLASK_STAGED"] = "1"
+    os.environ["SYMBIFLASK_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["SYMBIFLASK_ARTIFACT_DIR"] = os.path.join(workdir, "artifacts")
+    os.environ["FAKE_BITSTREAM_SIZE"] = str(bitstream_size)
+    # eager builds cannot wait for admission, room for every concurrent build of the biggest part
+    os.environ["SYMBIFLASK_CPU_BUDGET"] = str(8 * concurrency)
+    os.environ["SYMBIFLASK_MEM_BUDGET"] = str(16384 * concurrency)
+    os.chdir(workdir)
+
+
+class Bench:
+
+    def __init__(self, app_module, seed):
+        self.m = app_module
+        self.app = app_module.app
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.random = random.Random(seed)
+        self.counter = 0
+        self.fpgas = []
+        self.projects = []
+        self.tasks = []
+        self.samples = {name: [] for name in SCENARIOS}
+        self.queries = {name: [] for name in SCENARIOS}
+        self.errors = {name: 0 for name in SCENARIOS}
+        # count queries issued by the thread serving a request
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        @event.listens_for(Engine, "before_cursor_execute")
+        def count(*args, **kwargs):
+            self.local.queries = getattr(self.local, "queries", 0) + 1
+
+    def client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def unique(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def pick(self, items):
+        with self.lock:
+            return self.random.choice(items) if items else None
+
+    # time one request and record its query count
+    def call(self, scenario, method, url, **kwargs):
+        self.local.queries = 0
+        started = time.perf_counter()
+        response = getattr(self.client(), method)(url, **kwargs)
+        # drain streamed bodies so their cost is measured
+        body = response.get_data()
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples[scenario].append(elapsed)
+            self.queries[scenario].append(self.local.queries)
+            if response.status_code >= 500:
+                self.errors[scenario] += 1
+        return response, body
+
+    def fpga_create(self):
+        n = self.unique()
+        response, _ = self.call("fpga_create", "post", "/fpga",
+                                json={"family": "xc7", "model_id": "bench%d" % n, "builder": "Xilinx"})
+        if response.status_code == 201:
+            fpga = self.m.FPGA.query.filter_by(model_id="bench%d" % n).first()
+            with self.lock:
+                self.fpgas.append(fpga.id)
+
+    def project_create(self):
+        n = self.unique()
+        fpga_id = self.pick(self.fpgas) or 1
+        response, _ = self.call("project_create", "post", "/project",
+                                json={"Project_name": "bench%d" % n, "FPGA_id": fpga_id})
+        if response.status_code == 201:
+            project = self.m.Project.query.filter_by(Project_name="bench%d" % n, FPGA_id=fpga_id).first()
+            with self.lock:
+                self.projects.append(project.id)
+
+    def upload(self, project_id, name, size, top=False):
+        content = b"// bench\nmodule " + name.split(".")[0].encode() + b"();\nendmodule\n"
+        content += b"/" * max(0, size - len(content))
+        data = {"json": json.dumps({"Project_id": project_id, "top_level_flag": top}),
+                "file": (io.BytesIO(content), name)}
+        return self.call("hdl_upload", "post", "/file", data=data, content_type="multipart/form-data")
+
+    def hdl_upload(self):
+        project_id = self.pick(self.projects)
+        if project_id is None:
+            return
+        self.upload(project_id, "m%d.v" % self.unique(), self.pick(UPLOAD_SIZES))
+
+    def build(self):
+        project_id = self.pick(self.projects)
+        if project_id is None:
+            return
+        response, body = self.call("build", "post", "/toolchain",
+                                   json={"id": project_id, "mode": 2, "toolchain": "symbiflow", "priority": "ci"})
+        if response.status_code == 202:
+            with self.lock:
+                self.tasks.append(json.loads(body))
+
+    def status_poll(self):
+        task_id = self.pick(self.tasks)
+        if task_id is not None:
+            self.call("status_poll", "get", "/toolchain?id=" + task_id)
+
+    def bitstream(self):
+        project_id = self.pick(self.projects)
+        if project_id is not None:
+            self.call("bitstream", "get", "/bitstream?id=%d" % project_id)
+
+    def list_files(self):
+        self.call("list_files", "get", "/file?limit=100")
+
+    # a few boards and built projects for the read scenarios
+    def seed(self, projects):
+        with self.app.app_context():
+            for _ in range(max(1, projects // 4)):
+                self.fpga_create()
+            for _ in range(projects):
+                self.project_create()
+            for project_id in list(self.projects):
+                self.upload(project_id, "top.v", 1 << 10, top=True)
+            for project_id in list(self.projects):
+                response, body = self.call("build", "post", "/toolchain",
+                                           json={"id": project_id, "mode": 2, "toolchain": "symbiflow"})
+                if response.status_code == 202:
+                    self.tasks.append(json.loads(body))
+        # setup requests are not part of the measurement
+        self.samples = {name: [] for name in SCENARIOS}
+        self.queries = {name: [] for name in SCENARIOS}
+        self.errors = {name: 0 for name in SCENARIOS}
+
+    def worker(self, plan):
+        with self.app.app_context():
+            for scenario in plan:
+                try:
+                    getattr(self, scenario)()
+                except Exception as e:
+                    print(scenario, e)
+                    with self.lock:
+                        self.errors[scenario] += 1
+
+    def run(self, total, concurrency, mix):
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        plan = self.random.choices(names, weights=weights, k=total)
+        chunks = [plan[i::concurrency] for i in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.worker, chunks))
+        return time.perf_counter() - started
+
+    def report(self, elapsed, args):
+        scenarios = {}
+        for name in SCENARIOS:
+            samples = self.samples[name]
+            if not samples:
+                continue
+            scenarios[name] = {
+                "count": len(samples),
+                "errors": self.errors[name],
+                "throughput": len(samples) / elapsed,
+                "p50_ms": Percentile(samples, 50) * 1000,
+                "p95_ms": Percentile(samples, 95) * 1000,
+                "p99_ms": Percentile(samples, 99) * 1000,
+                "queries_mean": sum(self.queries[name]) / len(self.queries[name]),
+            }
+        total = sum(len(s) for s in self.samples.values())
+        return {
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "config": {"requests": args.requests, "concurrency": args.concurrency, "mix": args.mix,
+                       "projects": args.projects, "bitstream_size": args.bitstream_size, "seed": args.seed},
+            "elapsed_s": elapsed,
+            "throughput": total / elapsed if elapsed else 0,
+            "scenarios": scenarios,
+        }
+
+
+def ParseMix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit("unknown scenario: " + name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def PrintReport(result, baseline=None):
+    print("%-15s %7s %6s %9s %9s %9s %9s %8s" % ("scenario", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries"))
+    for name, s in result["scenarios"].items():
+        print("%-15s %7d %6d %9.1f %9.2f %9.2f %9.2f %8.2f" % (name, s["count"], s["errors"], s["throughput"],
+                                                               s["p50_ms"], s["p95_ms"], s["p99_ms"], s["queries_mean"]))
+        old = (baseline or {}).get("scenarios", {}).get(name)
+        if old:
+            print("%-15s %7s %6s %+8.1f%% %+8.1f%% %+8.1f%% %+8.1f%% %+8.2f" % (
+                "  vs baseline", "", "",
+                Change(old["throughput"], s["throughput"]), Change(old["p50_ms"], s["p50_ms"]),
+                Change(old["p95_ms"], s["p95_ms"]), Change(old["p99_ms"], s["p99_ms"]),
+                s["queries_mean"] - old["queries_mean"]))
+    print("total: %.1f req/s over %.2fs" % (result["throughput"], result["elapsed_s"]))
+
+
+def Change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SymbiFlask load and benchmark suite")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--projects", type=int, default=8)
+    parser.add_argument("--bitstream-size", type=int, default=1 << 20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), "bench_results"))
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+    mix = ParseMix(args.mix)
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix="symbiflask-bench-")
+    PrepareEnvironment(workdir, args.bitstream_size, args.concurrency)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import SymbiFlask
+    import celerytask
+    # builds run inline in the request that enqueues them
+    celerytask.app.conf.task_always_eager = True
+    celerytask.app.conf.task_eager_propagates = True
+    with SymbiFlask.app.app_context():
+        SymbiFlask.checkdatabase()
+
+    bench = Bench(SymbiFlask, args.seed)
+    bench.seed(args.projects)
+    elapsed = bench.run(args.requests, args.concurrency, mix)
+    result = bench.report(elapsed, args)
+    PrintReport(result, baseline)
+
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, result["timestamp"].replace(":", "-") + ".json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print("saved " + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os, errno, shutil, hashlib, tempfile
+
+BLOB_DIR = os.environ.get("SYMBIFLASK_BLOB_DIR", os.path.join(os.getcwd(), "blobs"))
+
+
+# sha256 keyed store of HDL file contents, shared by every project
+class BlobStore:
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    # hash a stream without storing it
+    def digest(self, stream):
+        h = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(1 << 16), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+    # store a stream, writing nothing when the content is already known
+    def ingest(self, stream):
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(prefix=".ingest-", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: stream.read(1 << 16), b""):
+                    h.update(chunk)
+                    f.write(chunk)
+            return self._place(tmp, h.hexdigest())
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # move a file already on disk into the store
+    def adopt(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        return self._place(path, h.hexdigest())
+
+    def _place(self, tmp, digest):
+        dst = self.path(digest)
+        if os.path.isfile(dst):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # blobs are shared through hardlinks and must never be written in place
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, dst)
+        return digest, os.path.getsize(dst)
+
+    # materialize a blob at dst as a hardlink, copying across filesystems
+    def link(self, digest, dst):
+        tmp = os.path.join(os.path.dirname(dst), "." + os.path.basename(dst) + ".link")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(self.path(digest), tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(self.path(digest), tmp)
+        os.replace(tmp, dst)
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
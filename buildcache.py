@@ -0,0 +1,179 @@
+import os, json, shutil, hashlib, fcntl, subprocess
+
+# name of the build output folder inside a project dir
+BUILD_DIR = "build"
+# name of the bitstream inside the build folder
+BITSTREAM = "symbiflow.bit"
+
+
+# hash a single file in chunks
+def HashFile(path, h=None):
+    if h is None:
+        h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h
+
+
+# content hash of the project bitstream, stored next to it once per build
+def BitstreamHash(prj_dir):
+    bitstream = os.path.join(prj_dir, BUILD_DIR, BITSTREAM)
+    sidecar = bitstream + ".sha256"
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(bitstream):
+            with open(sidecar) as f:
+                return f.read().strip()
+    except OSError:
+        pass
+    digest = HashFile(bitstream).hexdigest()
+    tmp = sidecar + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(digest)
+    os.replace(tmp, sidecar)
+    return digest
+
+
+# hash every source file of a project dir (build outputs excluded)
+def HashSources(prj_dir):
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(prj_dir)):
+        path = os.path.join(prj_dir, name)
+        # only the flat HDL files are sources, skip build/ and hidden files
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        h.update(name.encode() + b"\0")
+        HashFile(path, h)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# digest of the toolchain image, so a rebuilt image invalidates the cache
+def ImageDigest(image):
+    try:
+        out = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", image],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return out.stdout.decode().strip()
+    except Exception as e:
+        print(e)
+        return image
+
+
+# compute the cache key of a build
+def BuildKey(source_hash, PART_NAME, TOP_FILE, mode, image_digest):
+    h = hashlib.sha256()
+    for item in (source_hash, PART_NAME, TOP_FILE, str(mode), image_digest):
+        h.update(item.encode() + b"\0")
+    return h.hexdigest()
+
+
+# content addressed bitstream cache with LRU eviction
+class BuildCache:
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self.stats_path = os.path.join(self.root, "stats.json")
+        self.lock_path = os.path.join(self.root, ".lock")
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key + ".bit")
+
+    # exclusive lock across worker processes
+    def _locked(self):
+        fd = open(self.lock_path, "a")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _bump(self, counter):
+        try:
+            with open(self.stats_path) as f:
+                stats = json.load(f)
+        except Exception:
+            stats = {"hits": 0, "misses": 0, "evictions": 0}
+        stats[counter] = stats.get(counter, 0) + 1
+        tmp = self.stats_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp, self.stats_path)
+
+    def stats(self):
+        try:
+            with open(self.stats_path) as f:
+                stats = json.load(f)
+        except Exception:
+            stats = {"hits": 0, "misses": 0, "evictions": 0}
+        total = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = stats.get("hits", 0) / total if total else 0.0
+        stats["size"] = sum(size for _, size, _ in self._entries())
+        return stats
+
+    # whether a build is cached, refreshing its LRU position so it stays
+    # until the fetch that follows
+    def has(self, key):
+        try:
+            os.utime(self._entry(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    # copy a cached bitstream into the project build dir, True on hit
+    def fetch(self, key, prj_dir):
+        lock = self._locked()
+        try:
+            entry = self._entry(key)
+            if not os.path.isfile(entry):
+                self._bump("misses")
+                return False
+            dst_dir = os.path.join(prj_dir, BUILD_DIR)
+            os.makedirs(dst_dir, exist_ok=True)
+            shutil.copyfile(entry, os.path.join(dst_dir, BITSTREAM))
+            # refresh LRU position
+            os.utime(entry)
+            self._bump("hits")
+            return True
+        finally:
+            lock.close()
+
+    # store the bitstream of a finished build
+    def store(self, key, prj_dir):
+        src = os.path.join(prj_dir, BUILD_DIR, BITSTREAM)
+        if not os.path.isfile(src):
+            return False
+        lock = self._locked()
+        try:
+            entry = self._entry(key)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = entry + ".tmp"
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, entry)
+            self._evict()
+            return True
+        finally:
+            lock.close()
+
+    def _entries(self):
+        entries = []
+        for sub in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub)
+            if not os.path.isdir(sub_path):
+                continue
+            for name in os.listdir(sub_path):
+                if not name.endswith(".bit"):
+                    continue
+                path = os.path.join(sub_path, name)
+                st = os.stat(path)
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    # drop least recently used entries until the cache fits
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self._bump("evictions")
@@ -0,0 +1,118 @@
+import os, json, datetime, threading
+from sqlalchemy import create_engine, MetaData, Table, select
+
+# same database as the api
+DATABASE_URI = os.environ.get('SYMBIFLASK_DATABASE_URI', 'sqlite:///data.db')
+
+
+def Now():
+    return datetime.datetime.utcnow()
+
+
+# engine and reflected tables of the api database, shared by the worker side helpers
+class WorkerDatabase:
+
+    def __init__(self, uri=DATABASE_URI):
+        self.uri = uri
+        self.engine = None
+        self.meta = MetaData()
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        with self.lock:
+            if self.engine is None:
+                connect_args = {'timeout': 30} if self.uri.startswith('sqlite') else {}
+                self.engine = create_engine(self.uri, pool_pre_ping=True, connect_args=connect_args)
+            if name not in self.meta.tables:
+                Table(name, self.meta, autoload_with=self.engine)
+            return self.meta.tables[name]
+
+
+# one engine per worker process
+database = WorkerDatabase()
+
+
+# worker side writer of the Build table declared by the api
+class BuildHistory:
+
+    def __init__(self, db=database):
+        self.db = db
+        self.engine = None
+        self.table = None
+
+    def _connect(self):
+        if self.table is None:
+            self.table = self.db.table("Build")
+            self.engine = self.db.engine
+        return self.table
+
+    # update the row of a task, creating it for tasks enqueued elsewhere
+    def update(self, task_id, **values):
+        table = self._connect()
+        with self.engine.begin() as conn:
+            res = conn.execute(table.update().where(table.c.task_id == task_id).values(**values))
+            if res.rowcount == 0:
+                conn.execute(table.insert().values(task_id=task_id, queued_at=Now(), **values))
+
+    def get(self, task_id):
+        table = self._connect()
+        with self.engine.connect() as conn:
+            return conn.execute(table.select().where(table.c.task_id == task_id)).mappings().first()
+
+    # mark the bitstreams of a project past the newest keep as pruned, returning their hashes
+    def prune(self, Project_id, keep):
+        table = self._connect()
+        with self.engine.begin() as conn:
+            rows = conn.execute(select(table.c.id, table.c.artifact_hash)
+                                .where(table.c.Project_id == Project_id, table.c.artifact_hash.isnot(None),
+                                       table.c.pruned_at.is_(None))
+                                .order_by(table.c.id.desc()).offset(keep)).all()
+            if rows:
+                conn.execute(table.update().where(table.c.id.in_([row[0] for row in rows])).values(pruned_at=Now()))
+        return {row[1] for row in rows}
+
+    # bitstreams some build still keeps
+    def kept(self, hashes):
+        table = self._connect()
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(select(table.c.artifact_hash).where(
+                table.c.artifact_hash.in_(list(hashes)), table.c.pruned_at.is_(None)).distinct())}
+
+    def run(self, task_id, Project_id, PART_NAME, mode):
+        return BuildRun(self, task_id, Project_id, PART_NAME, mode)
+
+
+# history of one execution of RunSymbiFlow
+class BuildRun:
+
+    def __init__(self, history, task_id, Project_id, PART_NAME, mode):
+        self.history = history
+        self.task_id = task_id
+        self.stage_times = {}
+        # time spent waiting on the toolchain process
+        self.subprocess_wait = 0.0
+        self._write(Project_id=Project_id, part=PART_NAME, mode=mode, status="STARTED", started_at=Now())
+
+    # history must never break a build
+    def _write(self, **values):
+        try:
+            self.history.update(self.task_id, **values)
+        except Exception as e:
+            print(e)
+
+    def stage_start(self, stage):
+        self.stage_times[stage] = [Now().isoformat(), None]
+        self._write(stage_times=json.dumps(self.stage_times))
+
+    def stage_end(self, stage, waited=0.0):
+        self.subprocess_wait += waited
+        self.stage_times[stage][1] = Now().isoformat()
+        self._write(stage_times=json.dumps(self.stage_times))
+
+    # stopped before the end, waiting to run again
+    def requeue(self):
+        self._write(status="PENDING", started_at=None, stage_times=None)
+
+    def finish(self, failed, artifact_hash=None, artifact_size=None, status=None):
+        self._write(status=status or ("FAILURE" if failed else "SUCCESS"), exit_status=1 if failed else 0,
+                    finished_at=Now(), artifact_hash=artifact_hash, artifact_size=artifact_size)
@@ -0,0 +1,52 @@
+import os
+
+# build logs live in redis streams, one per task
+LOG_PREFIX = "symbiflask:log:"
+LOG_TTL = int(os.environ.get("SYMBIFLASK_LOG_TTL", 24 * 3600))
+LOG_MAXLEN = int(os.environ.get("SYMBIFLASK_LOG_MAXLEN", 100000))
+
+
+def LogKey(task_id):
+    return LOG_PREFIX + task_id
+
+
+# append one line of toolchain output to the task log
+def PublishLine(rdb, task_id, line):
+    key = LogKey(task_id)
+    with rdb.pipeline() as pipe:
+        pipe.xadd(key, {"line": line}, maxlen=LOG_MAXLEN, approximate=True)
+        pipe.expire(key, LOG_TTL)
+        pipe.execute()
+
+
+# mark the end of the task log so readers can stop
+def CloseLog(rdb, task_id):
+    key = LogKey(task_id)
+    with rdb.pipeline() as pipe:
+        pipe.xadd(key, {"eof": "1"})
+        pipe.expire(key, LOG_TTL)
+        pipe.execute()
+
+
+# whole log of a task as text, for archiving
+def LogText(rdb, task_id):
+    lines = []
+    for entry_id, fields in rdb.xrange(LogKey(task_id)):
+        if b"line" in fields:
+            lines.append(fields[b"line"].decode(errors="replace"))
+    return "\n".join(lines) + "\n"
+
+
+# yield (entry id, line) from the log after last_id, None as keepalive
+def FollowLog(rdb, task_id, last_id="0", block_ms=15000):
+    key = LogKey(task_id)
+    while True:
+        entries = rdb.xread({key: last_id}, block=block_ms, count=500)
+        if not entries:
+            yield None
+            continue
+        for entry_id, fields in entries[0][1]:
+            last_id = entry_id
+            if b"eof" in fields:
+                return
+            yield entry_id.decode(), fields[b"line"].decode(errors="replace")
@@ -0,0 +1,92 @@
+import os, json, hashlib
+from buildcache import BUILD_DIR, HashFile
+
+# toolchain stages in execution order with the extensions they produce
+STAGES = [
+    ("synth", (".eblif",)),
+    ("pack", (".net",)),
+    ("place", (".place",)),
+    ("route", (".route",)),
+    ("bitstream", (".fasm", ".bit")),
+]
+# last stage run by each mode, the full flow for unknown modes
+MODE_STAGES = {"0": "synth", "1": "route", "2": "bitstream"}
+MODE_STAGES.update(json.loads(os.environ.get("SYMBIFLASK_MODE_STAGES", "{}")))
+# images reading STAGE run one container per stage, the others run the whole
+# flow of a mode in one container
+STAGED = os.environ.get("SYMBIFLASK_STAGED", "0") == "1"
+# per project record of stage fingerprints
+MANIFEST = ".stages.json"
+
+
+# stages a mode runs, in execution order. Unstaged builds are one run
+# checked against the outputs of the last stage
+def StagesFor(mode):
+    names = [name for name, _ in STAGES]
+    stages = STAGES[:names.index(MODE_STAGES.get(str(mode), names[-1])) + 1]
+    return stages if STAGED else stages[-1:]
+
+
+# modes stopping early leave no bitstream to cache or archive
+def ReachesBitstream(mode):
+    return StagesFor(mode)[-1] == STAGES[-1]
+
+
+# hash the outputs of a stage, None if the stage left nothing behind
+def HashOutputs(prj_dir, extensions):
+    build_dir = os.path.join(prj_dir, BUILD_DIR)
+    if not os.path.isdir(build_dir):
+        return None
+    h = hashlib.sha256()
+    found = False
+    for name in sorted(os.listdir(build_dir)):
+        path = os.path.join(build_dir, name)
+        if not name.endswith(extensions) or not os.path.isfile(path):
+            continue
+        h.update(name.encode() + b"\0")
+        HashFile(path, h)
+        h.update(b"\0")
+        found = True
+    return h.hexdigest() if found else None
+
+
+# stage fingerprints persisted inside the project build dir
+class StageManifest:
+
+    def __init__(self, prj_dir):
+        self.prj_dir = prj_dir
+        self.path = os.path.join(prj_dir, BUILD_DIR, MANIFEST)
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except Exception:
+            self.stages = {}
+
+    # a stage can be skipped if its inputs match and its outputs are intact
+    def fresh(self, stage, extensions, input_fp):
+        record = self.stages.get(stage)
+        if not record or record.get("input") != input_fp:
+            return False
+        output_fp = HashOutputs(self.prj_dir, extensions)
+        return output_fp is not None and output_fp == record.get("output")
+
+    def output(self, stage):
+        return self.stages[stage]["output"]
+
+    def record(self, stage, input_fp, output_fp):
+        self.stages[stage] = {"input": input_fp, "output": output_fp}
+        self.save()
+
+    # forget a stage and everything after it
+    def invalidate(self, stage):
+        names = [name for name, _ in STAGES]
+        for name in names[names.index(stage):]:
+            self.stages.pop(name, None)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.stages, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,51 @@
+import json, time
+
+# task state transitions are published on one channel per task
+STATUS_PREFIX = "symbiflask:status:"
+
+
+def StatusChannel(task_id):
+    return STATUS_PREFIX + task_id
+
+
+# announce a state transition of a task
+def PublishStatus(rdb, task_id, state, **extra):
+    event = dict(extra, task_id=task_id, task_status=state)
+    rdb.publish(StatusChannel(task_id), json.dumps(event))
+
+
+# block until check() holds or the timeout expires, True when it holds.
+# check() is evaluated after subscribing so no transition can be missed, and
+# again on every event since stage and retry events leave the state as it is
+def WaitStatus(rdb, task_id, timeout, check):
+    pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(StatusChannel(task_id))
+        if check():
+            return True
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            message = pubsub.get_message(timeout=remaining)
+            if message is not None and message["type"] == "message" and check():
+                return True
+    finally:
+        pubsub.close()
+
+
+# yield task events as they are published, None as keepalive
+def FollowStatus(rdb, task_id, keepalive=15):
+    pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(StatusChannel(task_id))
+        yield None
+        while True:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None or message["type"] != "message":
+                yield None
+                continue
+            yield json.loads(message["data"])
+    finally:
+        pubsub.close()
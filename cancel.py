@@ -0,0 +1,81 @@
+import os, time, threading
+
+# cancel requests for running tasks, read by the worker running them
+CANCEL_PREFIX = "symbiflask:cancel:"
+CANCEL_TTL = int(os.environ.get("SYMBIFLASK_CANCEL_TTL", 24 * 3600))
+# seconds between two checks of a running build
+CANCEL_POLL = float(os.environ.get("SYMBIFLASK_CANCEL_POLL", 2))
+
+CANCELLED = "cancelled"
+PREEMPTED = "preempted"
+TIMEOUT = "timeout"
+
+
+def CancelKey(task_id):
+    return CANCEL_PREFIX + task_id
+
+
+# ask the worker running a task to stop it, reason is cancelled or preempted
+def RequestCancel(rdb, task_id, reason=CANCELLED):
+    rdb.set(CancelKey(task_id), reason, ex=CANCEL_TTL)
+
+
+def CancelReason(rdb, task_id):
+    reason = rdb.get(CancelKey(task_id))
+    return reason.decode() if reason is not None else None
+
+
+def ClearCancel(rdb, task_id):
+    rdb.delete(CancelKey(task_id))
+
+
+# thread stopping the container of a build on cancel, preemption or timeout
+class Watchdog:
+
+    def __init__(self, rdb, task_id, executor, timeout=None, output=None):
+        self.rdb = rdb
+        self.task_id = task_id
+        self.executor = executor
+        self.deadline = time.time() + timeout if timeout else None
+        self.timeout = timeout
+        self.output = output
+        self.reason = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+
+    def start(self):
+        self.check()
+        self.thread.start()
+        return self
+
+    # reason to stop the build, set once
+    def check(self):
+        if self.reason is None:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.reason = TIMEOUT
+            else:
+                try:
+                    self.reason = CancelReason(self.rdb, self.task_id)
+                except Exception as e:
+                    print(e)
+        return self.reason
+
+    def _watch(self):
+        announced = False
+        while not self.done.wait(CANCEL_POLL):
+            if self.check():
+                if self.output and not announced:
+                    announced = True
+                    try:
+                        self.output("stopping build: " + self.reason +
+                                    (" after %ds" % self.timeout if self.reason == TIMEOUT else ""))
+                    except Exception as e:
+                        print(e)
+                # kill again on every round, a stage may start between two checks
+                try:
+                    self.executor.kill(self.task_id)
+                except Exception as e:
+                    print(e)
+
+    def stop(self):
+        self.done.set()
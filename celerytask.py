@@ -1,26 +1,468 @@
 from celery import Celery
-import os
+from celery.signals import worker_process_shutdown, worker_ready, task_prerun, task_postrun, task_failure
+from buildcache import BuildCache, HashSources, ImageDigest, BuildKey, BitstreamHash, BUILD_DIR, BITSTREAM
+from buildstages import StagesFor, ReachesBitstream, StageManifest, HashOutputs, STAGED
+from executor import MakeExecutor
+from buildlog import PublishLine, CloseLog, LogText
+from buildstatus import PublishStatus
+from scheduler import Budget, Limits, RouteTask, TimeoutFor, ADMISSION_RETRY, DEFAULT_PRIORITY
+from cancel import Watchdog, RequestCancel, CancelReason, ClearCancel, CANCELLED, PREEMPTED
+from buildhistory import BuildHistory, Now
+from retention import ArtifactPath, ArchiveBitstream, ExtractArtifact, IsArchived, RemoveArtifact, PruneIntermediates, KEEP_BUILDS
+from metrics import QUEUE_WAIT, BUILD_DURATION, STAGE_DURATION, CACHE_LOOKUPS
+from profiler import ShouldProfile, StartProfile, ProfileStore
+from tombstone import Purger, RemoveTree, TRASH_DIR
+from blobstore import BlobStore
+from verilogscan import ScanIndex
+from artifactstore import MakeStore, FetchSources, ArtifactKey, BuildLogKey, SCRATCH_DIR
+from devices import DeviceRegistry, AttachedDevices, ProgrammerFor, PROGRAM_WAIT
+import os, shutil, time, tempfile, redis
+# broker, results and coordination, reachable from every build node
+BROKER_URL = os.environ.get("SYMBIFLASK_BROKER_URL", 'redis://localhost:6379/0')
+RESULT_BACKEND = os.environ.get("SYMBIFLASK_RESULT_BACKEND", 'redis://localhost:6379')
+REDIS_URL = os.environ.get("SYMBIFLASK_REDIS_URL", 'redis://localhost:6379/1')
 # celery instance
-app = Celery('celerytask', backend='redis://localhost:6379', broker='redis://localhost:6379/0')
+app = Celery('celerytask', backend=RESULT_BACKEND, broker=BROKER_URL)
+# report STARTED so status waiters see the task leave the queue
+app.conf.task_track_started = True
+# the Build table is the lasting record, backend results can expire early
+app.conf.result_expires = int(os.environ.get("SYMBIFLASK_RESULT_EXPIRES", 3600))
+# per part queues, with priorities served lowest number first
+app.conf.task_routes = (RouteTask,)
+app.conf.broker_transport_options = {'priority_steps': list(range(10)), 'queue_order_strategy': 'priority'}
+# one build per process at a time so admission control sees every reservation
+app.conf.worker_prefetch_multiplier = 1
+app.conf.task_acks_late = True
+# redis connection shared with the api for build coordination
+rdb = redis.Redis.from_url(REDIS_URL)
+
+# in-flight build registry settings
+INFLIGHT_PREFIX = "symbiflask:inflight:"
+INFLIGHT_TTL = int(os.environ.get("SYMBIFLASK_INFLIGHT_TTL", 6 * 3600))
+
+# build cache settings
+CACHE_DIR = os.environ.get("SYMBIFLASK_CACHE_DIR", os.path.join(os.getcwd(), "cache"))
+CACHE_MAX_BYTES = int(os.environ.get("SYMBIFLASK_CACHE_MAX_BYTES", 1 << 30))
+cache = BuildCache(CACHE_DIR, CACHE_MAX_BYTES)
+# toolchain executor (warm container pool by default)
+executor = MakeExecutor()
+# cpu and memory budget of this host
+budget = Budget(rdb)
+# build history writer
+history = BuildHistory()
+# opt-in profiles of RunSymbiFlow
+profiles = ProfileStore()
+# remover of deleted projects and files
+purger = Purger()
+# shared store of source bundles, bitstreams and logs, None on a single host
+store = MakeStore()
+# boards available to the programming task
+registry = DeviceRegistry(rdb)
+
+
+# forget reservations of processes that did not survive a restart of this worker
+@worker_ready.connect
+def ResetBudget(sender=None, **kwargs):
+    try:
+        budget.reset(sender.hostname)
+    except Exception as e:
+        print(e)
+
+
+# publish the boards plugged into this host
+@worker_ready.connect
+def RegisterDevices(**kwargs):
+    try:
+        registry.register(AttachedDevices())
+    except Exception as e:
+        print(e)
+
+
+# finish deletions whose purge task was lost
+@worker_ready.connect
+def SweepDeleted(**kwargs):
+    try:
+        PurgeDeleted.delay()
+    except Exception as e:
+        print(e)
+
+
+# stop the warm containers together with the worker process
+@worker_process_shutdown.connect
+def ShutdownExecutor(**kwargs):
+    if hasattr(executor, "shutdown"):
+        executor.shutdown()
 
-# delclaring the symbiflow runner script
-@app.task
-def RunSymbiFlow(PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode=2):
 
-    # assemple the docker cmd
-    cmd = ("docker run --rm -it"
-           " -e BOARD_MODEL=" + PART_NAME + " -e TOP_FILE=" + TOP_FILE + " -e PRJ_DIR=" + PRJ_DIR +
-           " -e MODE=" + str(mode) +
-           " --privileged -v /dev/bus/usb:/dev/bus/usb" + " -v " + PRJ_DIR_HOST + ":" + PRJ_DIR +
-           " symbiflow:" + PART_NAME)
+# publish state transitions of the runner for status subscribers
+@task_prerun.connect
+def AnnounceStart(task_id=None, task=None, **kwargs):
+    if task is not None and task.name == RunSymbiFlow.name:
+        try:
+            PublishStatus(rdb, task_id, "STARTED")
+        except Exception as e:
+            print(e)
 
-    # debug print
-    print(cmd)
+
+# the result is already stored in the backend when postrun fires
+@task_postrun.connect
+def AnnounceEnd(task_id=None, task=None, retval=None, state=None, **kwargs):
+    if task is not None and task.name == RunSymbiFlow.name:
+        try:
+            PublishStatus(rdb, task_id, state, task_result=retval if state == "SUCCESS" else None)
+        except Exception as e:
+            print(e)
+
+
+# a runner that raised, during admission included, never recorded its end.
+# Close its history so identical requests stop joining it
+@task_failure.connect
+def CloseFailedBuild(sender=None, task_id=None, kwargs=None, **extra):
+    if sender is None or sender.name != RunSymbiFlow.name:
+        return
     try:
-        # execute the cmd
-        os.system(cmd)
+        build = history.get(task_id)
+        if build is not None and build["finished_at"] is None:
+            history.update(task_id, status="FAILURE", exit_status=1, finished_at=Now())
+        budget.release(task_id)
+        if kwargs and kwargs.get("INFLIGHT_KEY"):
+            ReleaseInflight(kwargs["INFLIGHT_KEY"], task_id)
+        CloseLog(rdb, task_id)
     except Exception as e:
         print(e)
+
+
+# delclaring the symbiflow runner script
+@app.task(bind=True)
+def RunSymbiFlow(self, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode=2, INFLIGHT_KEY=None, PROJECT_ID=None,
+                 ENQUEUED_AT=None, PROFILE=False, BUNDLE=None, PRIORITY=DEFAULT_PRIORITY, SOURCES=None):
+    task_id = self.request.id
+    # cancelled while waiting for admission
+    if CancelReason(rdb, task_id) == CANCELLED:
+        history.update(task_id, status="REVOKED", exit_status=1, finished_at=Now())
+        if INFLIGHT_KEY:
+            ReleaseInflight(INFLIGHT_KEY, task_id)
+        CloseLog(rdb, task_id)
         return True
-    else:
+    # a cached bitstream is only copied, so the first delivery looks it up
+    # before admission and a hit neither waits for room nor stops other
+    # builds. Admission retries do not fetch the sources again
+    reservation = None
+    cached = False
+    if self.request.retries == 0 and ReachesBitstream(mode):
+        # sources come from the shared store when the api is on another host
+        if BUNDLE and store is not None:
+            PRJ_DIR_HOST = FetchSources(store, BUNDLE, os.path.join(SCRATCH_DIR, os.path.basename(PRJ_DIR_HOST)))
+            BUNDLE = None
+        cached = cache.has(BuildKey(HashSources(PRJ_DIR_HOST), PART_NAME, TOP_FILE, mode,
+                                    ImageDigest("symbiflow:" + PART_NAME)))
+    if not cached:
+        # admission control, wait in the queue until the host has room for the build
+        reservation = budget.acquire(task_id, PART_NAME, PRIORITY, self.request.hostname)
+        if reservation is None:
+            # make room by stopping builds of lower classes, they are queued again
+            for victim in budget.preempt(task_id, PART_NAME, PRIORITY, self.request.hostname):
+                if CancelReason(rdb, victim) is None:
+                    RequestCancel(rdb, victim, PREEMPTED)
+            raise self.retry(countdown=ADMISSION_RETRY, max_retries=None)
+    started = time.time()
+    if ENQUEUED_AT:
+        QUEUE_WAIT.labels(PART_NAME).observe(max(0, started - ENQUEUED_AT))
+    run = history.run(task_id, PROJECT_ID, PART_NAME, mode)
+    profile = StartProfile() if ShouldProfile(PROFILE) else None
+    # stops the container on cancel, preemption or timeout
+    watchdog = Watchdog(rdb, task_id, executor, TimeoutFor(PART_NAME, mode),
+                        lambda line: PublishLine(rdb, task_id, line)).start()
+    failed = True
+    try:
+        # sources come from the shared store when the api is on another host
+        if BUNDLE and store is not None:
+            PRJ_DIR_HOST = FetchSources(store, BUNDLE, os.path.join(SCRATCH_DIR, os.path.basename(PRJ_DIR_HOST)))
+        failed = _RunSymbiFlow(task_id, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode,
+                               Limits(reservation) if reservation else None, run, watchdog, SOURCES)
+    finally:
+        watchdog.stop()
+        preempted = watchdog.reason == PREEMPTED
+        elapsed = time.time() - started
+        BUILD_DURATION.labels(PART_NAME, watchdog.reason or ("failure" if failed else "success")).observe(elapsed)
+        if profile is not None:
+            profile.disable()
+            # python side overhead is what the toolchain processes do not account for
+            profiles.save("task", "RunSymbiFlow", profile, task_id=task_id, part=PART_NAME, duration=elapsed,
+                          subprocess_wait=run.subprocess_wait, overhead=elapsed - run.subprocess_wait)
+        if preempted:
+            run.requeue()
+        else:
+            RecordBuild(run, failed, PRJ_DIR_HOST, "REVOKED" if watchdog.reason == CANCELLED else None,
+                        ReachesBitstream(mode))
+            ApplyRetention(PROJECT_ID, PRJ_DIR_HOST)
+        budget.release(task_id)
+        # a preempted build keeps its in-flight entry and log, it runs again
+        if not preempted:
+            # let identical requests start a fresh build from now on
+            if INFLIGHT_KEY:
+                ReleaseInflight(INFLIGHT_KEY, task_id)
+            CloseLog(rdb, task_id)
+            if store is not None:
+                PushLog(task_id)
+    if preempted:
+        ClearCancel(rdb, task_id)
+        raise self.retry(countdown=ADMISSION_RETRY, max_retries=None)
+    return failed
+
+
+# flash the bitstream of a build on a leased board, on the programming queue
+# so compile slots never wait for a board
+@app.task(bind=True)
+def ProgramBoard(self, BUILD_TASK_ID, PART_NAME, TOP_FILE, PROJECT_ID=None, ENQUEUED_AT=None):
+    task_id = self.request.id
+    if CancelReason(rdb, task_id):
+        registry.withdraw(task_id, PART_NAME, PROJECT_ID)
+        return "Error: programming cancelled"
+    # wait for the compile without holding a worker. The row is written
+    # before the build is enqueued, so a missing row was purged with its project
+    build = history.get(BUILD_TASK_ID)
+    if build is None:
+        registry.withdraw(task_id, PART_NAME, PROJECT_ID)
+        return "Error: build not found"
+    if build["finished_at"] is None:
+        if ENQUEUED_AT and time.time() - ENQUEUED_AT > PROGRAM_WAIT:
+            registry.withdraw(task_id, PART_NAME, PROJECT_ID)
+            return "Error: build did not finish in time"
+        raise self.retry(countdown=ADMISSION_RETRY, max_retries=None)
+    if build["exit_status"] != 0 or not build["artifact_hash"]:
+        registry.withdraw(task_id, PART_NAME, PROJECT_ID)
+        return "Error: build failed, nothing to program"
+    # queue for a board of this model in fair share order
+    device = registry.acquire(task_id, PART_NAME, PROJECT_ID, ENQUEUED_AT)
+    if device is None:
+        raise self.retry(countdown=ADMISSION_RETRY, max_retries=None)
+
+    def log(line):
+        print(line)
+        try:
+            PublishLine(rdb, task_id, line)
+        except Exception as e:
+            print(e)
+
+    workdir = tempfile.mkdtemp(prefix="program-")
+    try:
+        artifact_hash = build["artifact_hash"]
+        archive = None
+        if not IsArchived(artifact_hash):
+            if store is None:
+                return "Error: bitstream not available on this host"
+            # fetched for this flash only, programming hosts keep no archive
+            archive = os.path.join(workdir, os.path.basename(ArtifactPath(artifact_hash)))
+            store.get(ArtifactKey(artifact_hash), archive)
+        # the programmer wants the plain bitstream
+        bitstream = ExtractArtifact(artifact_hash, os.path.join(workdir, BITSTREAM), archive)
+        log("programming " + device["serial"])
+        code = ProgrammerFor(device).program(device, PART_NAME, bitstream, TOP_FILE, log)
+        return {"device": device["serial"], "exit_status": code}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        registry.release(device["serial"], task_id)
+        CloseLog(rdb, task_id)
+
+
+# background half of project and file deletion, the api has already
+# tombstoned the rows and moved their files to the trash
+@app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=8)
+def PurgeDeleted(self, PROJECT_ID=None, FILE_IDS=None, TRASH=()):
+    done = {"files": 0, "rows": 0}
+
+    def progress(key):
+        def report(count):
+            done[key] = count
+            self.update_state(state="PROGRESS", meta=dict(done))
+        return report
+
+    # a call without arguments sweeps everything left behind
+    sweep = PROJECT_ID is None and FILE_IDS is None
+    if sweep:
+        TRASH = [os.path.join(TRASH_DIR, name) for name in os.listdir(TRASH_DIR)] if os.path.isdir(TRASH_DIR) else []
+    for path in TRASH:
+        done["files"] += RemoveTree(path, progress("files"))
+
+    hashes, artifacts = set(), set()
+    project_ids = purger.tombstoned_projects() if sweep else ([PROJECT_ID] if PROJECT_ID is not None else [])
+    for project_id in project_ids:
+        deleted, found, archived = purger.purge_project(project_id, progress("rows"))
+        done["rows"] += deleted
+        hashes |= found
+        artifacts |= archived
+    if sweep or FILE_IDS:
+        deleted, found = purger.purge_files(None if sweep else FILE_IDS, progress("rows"))
+        done["rows"] += deleted
+        hashes |= found
+
+    # blobs no row refers to anymore
+    if hashes:
+        blobs = BlobStore()
+        removed = hashes - purger.referenced(hashes)
+        for digest in removed:
+            blobs.remove(digest)
+        ScanIndex(rdb).drop(list(removed))
+    # bitstreams of the purged builds, once no other build keeps them
+    if artifacts:
+        DropArtifacts(artifacts)
+    return done
+
+
+# close the history of a build, keeping its bitstream for later retrieval
+def RecordBuild(run, failed, PRJ_DIR_HOST, status=None, bitstream=True):
+    artifact_hash = artifact_size = None
+    # a bitstream left behind by an earlier full build is not this build's output
+    if not failed and bitstream:
+        try:
+            bitstream = os.path.join(PRJ_DIR_HOST, BUILD_DIR, BITSTREAM)
+            artifact_hash = BitstreamHash(PRJ_DIR_HOST)
+            artifact_size = os.path.getsize(bitstream)
+            # compressed, once per content
+            artifact = ArchiveBitstream(bitstream, artifact_hash)
+            # the api and other nodes fetch it from the shared store, which is
+            # where retention removes it, so no copy is left on this node
+            if store is not None:
+                if not store.has(ArtifactKey(artifact_hash)):
+                    store.put(ArtifactKey(artifact_hash), artifact)
+                RemoveArtifact(artifact_hash)
+        except Exception as e:
+            print(e)
+    run.finish(failed, artifact_hash, artifact_size, status)
+
+
+# retention policy of a project: bounded intermediates where the build ran,
+# last KEEP_BUILDS bitstreams where the api serves them from
+def ApplyRetention(PROJECT_ID, PRJ_DIR_HOST):
+    try:
+        freed = PruneIntermediates(PRJ_DIR_HOST)
+        if freed:
+            print("pruned %d bytes of intermediates in %s" % (freed, PRJ_DIR_HOST))
+        if PROJECT_ID is not None:
+            if store is None:
+                PruneArtifacts(PROJECT_ID)
+            else:
+                PruneArtifacts.delay(PROJECT_ID)
+    except Exception as e:
+        print(e)
+
+
+# archived bitstreams of a project past the newest KEEP_BUILDS, routed to the api host
+@app.task(autoretry_for=(Exception,), retry_backoff=True, max_retries=8)
+def PruneArtifacts(PROJECT_ID):
+    hashes = history.prune(PROJECT_ID, KEEP_BUILDS)
+    if hashes:
+        DropArtifacts(hashes)
+
+
+# remove archived bitstreams here and in the shared store, except the ones
+# a build still keeps since builds with the same output share them
+def DropArtifacts(hashes):
+    for artifact_hash in hashes - history.kept(hashes):
+        RemoveArtifact(artifact_hash)
+        if store is not None:
+            store.delete(ArtifactKey(artifact_hash))
+
+
+# keep the log of a build after its redis stream expires
+def PushLog(task_id):
+    path = os.path.join(SCRATCH_DIR, "." + task_id + ".log")
+    try:
+        os.makedirs(SCRATCH_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(LogText(rdb, task_id))
+        store.put(BuildLogKey(task_id), path)
+    except Exception as e:
+        print(e)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# drop an in-flight entry only if it still points to the given task
+def ReleaseInflight(key, task_id):
+    with rdb.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) == task_id.encode():
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+        except redis.WatchError:
+            pass
+
+
+def _RunSymbiFlow(task_id, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode, limits, run, watchdog, sources=None):
+    # toolchain output goes to the task log as it is produced
+    def log(line):
+        print(line)
+        try:
+            PublishLine(rdb, task_id, line)
+        except Exception as e:
+            print(e)
+
+    # stage progress for status subscribers
+    def announce(stage):
+        try:
+            PublishStatus(rdb, task_id, "STARTED", stage=stage)
+        except Exception as e:
+            print(e)
+
+    # the mode selects how far the flow goes
+    stages = StagesFor(mode)
+    bitstream = ReachesBitstream(mode)
+    # look up the build cache before starting a container
+    source_hash = HashSources(PRJ_DIR_HOST)
+    image_digest = ImageDigest("symbiflow:" + PART_NAME)
+    key = BuildKey(source_hash, PART_NAME, TOP_FILE, mode, image_digest)
+    if bitstream and cache.fetch(key, PRJ_DIR_HOST):
+        CACHE_LOOKUPS.labels("hit").inc()
+        log("cache hit: " + key)
         return False
+    if bitstream:
+        CACHE_LOOKUPS.labels("miss").inc()
+    # admitted for a cache hit whose entry was evicted since, nothing limits the containers
+    if limits is None:
+        log("cache entry evicted before use, request the build again")
+        return True
+
+    # walk the stages, resuming from the first one whose inputs changed
+    manifest = StageManifest(PRJ_DIR_HOST)
+    input_fp = BuildKey(source_hash, PART_NAME, TOP_FILE, "", image_digest)
+    for stage, extensions in stages:
+        if manifest.fresh(stage, extensions, input_fp):
+            log("stage up to date: " + stage)
+            input_fp = manifest.output(stage)
+            continue
+        # no new stage once the build is being stopped
+        if watchdog.check():
+            log("build stopped: " + watchdog.reason)
+            return True
+        log("running stage: " + stage)
+        announce(stage)
+        run.stage_start(stage)
+        stage_started = time.time()
+        try:
+            # execute the stage
+            status = executor.run(PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode, stage if STAGED else None, log,
+                                  limits, task_id, sources)
+            waited = time.time() - stage_started
+            STAGE_DURATION.labels(PART_NAME, stage).observe(waited)
+            run.stage_end(stage, waited)
+        except Exception as e:
+            log(str(e))
+            manifest.invalidate(stage)
+            return True
+        output_fp = HashOutputs(PRJ_DIR_HOST, extensions)
+        if status != 0 or output_fp is None:
+            log("stage failed: " + stage)
+            manifest.invalidate(stage)
+            return True
+        manifest.record(stage, input_fp, output_fp)
+        input_fp = output_fp
+
+    # every stage is now up to date, keep the bitstream for identical future builds
+    if bitstream:
+        cache.store(key, PRJ_DIR_HOST)
+    return False
@@ -0,0 +1,176 @@
+import os, json, time, socket, shutil, hashlib, tempfile, redis
+from executor import BuildEnv, Stream, CONTAINER_ROOT
+
+# boards attached to this host, [{"serial": ..., "model_id": ..., "path": "/dev/bus/usb/001/004"}]
+DEVICES = json.loads(os.environ.get("SYMBIFLASK_DEVICES", "[]"))
+# simulated boards per model, "xc7a35t:2,xc7a100t:1", for tests and benchmarks
+SIM_DEVICES = os.environ.get("SYMBIFLASK_SIM_DEVICES", "")
+SIM_DIR = os.environ.get("SYMBIFLASK_SIM_DIR", os.path.join(os.getcwd(), "sim_devices"))
+SIM_FLASH_SECONDS = float(os.environ.get("SYMBIFLASK_SIM_FLASH_SECONDS", 1))
+# waiters that stopped retrying for this long lose their place
+WAITER_TTL = int(os.environ.get("SYMBIFLASK_WAITER_TTL", 120))
+# seconds a programming task waits for its build to finish
+PROGRAM_WAIT = int(os.environ.get("SYMBIFLASK_PROGRAM_WAIT", 24 * 3600))
+
+DEVICE_PREFIX = "symbiflask:devices:"
+LEASES = "symbiflask:device-leases"
+WAIT_PREFIX = "symbiflask:device-wait:"
+SEEN = "symbiflask:device-seen"
+
+
+# boards of this host from the environment, simulated ones included
+def AttachedDevices():
+    devices = list(DEVICES)
+    for item in filter(None, SIM_DEVICES.split(",")):
+        model_id, _, count = item.partition(":")
+        for n in range(int(count or 1)):
+            devices.append({"serial": "sim-%s-%s-%d" % (socket.gethostname(), model_id, n),
+                            "model_id": model_id, "path": None, "sim": True})
+    return devices
+
+
+# board registry shared by the programming workers, leases taken in fair share order
+class DeviceRegistry:
+
+    def __init__(self, rdb, host=None):
+        self.rdb = rdb
+        self.host = host or socket.gethostname()
+
+    # publish the boards of this host, dropping leases of a previous run
+    def register(self, devices):
+        with self.rdb.pipeline() as pipe:
+            for device in devices:
+                entry = dict(device, host=self.host)
+                pipe.hset(DEVICE_PREFIX + device["model_id"], device["serial"], json.dumps(entry))
+                pipe.hdel(LEASES, device["serial"])
+            pipe.execute()
+
+    def devices(self, model_id):
+        return {k.decode(): json.loads(v) for k, v in self.rdb.hgetall(DEVICE_PREFIX + model_id).items()}
+
+    # every registered board with its lease
+    def all(self):
+        leases = self.leases()
+        boards = []
+        for key in self.rdb.scan_iter(match=DEVICE_PREFIX + "*"):
+            for serial, device in {k.decode(): json.loads(v) for k, v in self.rdb.hgetall(key).items()}.items():
+                boards.append(dict(device, lease=leases.get(serial)))
+        return boards
+
+    def leases(self):
+        return {k.decode(): json.loads(v) for k, v in self.rdb.hgetall(LEASES).items()}
+
+    # lease a board of this host, None while the task has to wait for its turn
+    def acquire(self, task_id, model_id, project_id, enqueued_at=None):
+        me = task_id + "|" + str(project_id)
+        wait_key = WAIT_PREFIX + model_id
+        now = time.time()
+        self.rdb.zadd(wait_key, {me: enqueued_at or now}, nx=True)
+        self.rdb.hset(SEEN, me, now)
+        with self.rdb.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(LEASES, wait_key)
+                    leases = {k.decode(): json.loads(v) for k, v in pipe.hgetall(LEASES).items()}
+                    # a retried task keeps its board
+                    for serial, lease in leases.items():
+                        if lease["task_id"] == task_id:
+                            pipe.unwatch()
+                            return self.devices(model_id)[serial]
+                    devices = self.devices(model_id)
+                    free = [s for s in devices if s not in leases]
+                    waiters = pipe.zrange(wait_key, 0, -1, withscores=True)
+                    seen = pipe.hmget(SEEN, [m for m, _ in waiters]) if waiters else []
+                    live = [(m.decode(), score) for (m, score), last in zip(waiters, seen)
+                            if last is not None and now - float(last) < WAITER_TTL]
+                    # fair share: projects holding fewer boards first, then arrival order
+                    held = {}
+                    for lease in leases.values():
+                        held[lease["project_id"]] = held.get(lease["project_id"], 0) + 1
+                    live.sort(key=lambda w: (held.get(w[0].split("|")[1], 0), w[1]))
+                    order = [m for m, _ in live]
+                    rank = order.index(me) if me in order else len(order)
+                    mine = [s for s in free if devices[s]["host"] == self.host]
+                    if rank >= len(free) or not mine:
+                        pipe.unwatch()
+                        return None
+                    serial = mine[0]
+                    pipe.multi()
+                    pipe.hset(LEASES, serial, json.dumps({"task_id": task_id, "project_id": str(project_id),
+                                                          "since": now}))
+                    pipe.zrem(wait_key, me)
+                    pipe.hdel(SEEN, me)
+                    # forget waiters that gave up
+                    stale = [m for m, _ in waiters if m.decode() not in dict(live)]
+                    if stale:
+                        pipe.zrem(wait_key, *stale)
+                        pipe.hdel(SEEN, *stale)
+                    pipe.execute()
+                    return devices[serial]
+                except redis.WatchError:
+                    continue
+
+    def release(self, serial, task_id):
+        with self.rdb.pipeline() as pipe:
+            try:
+                pipe.watch(LEASES)
+                lease = pipe.hget(LEASES, serial)
+                if lease is not None and json.loads(lease)["task_id"] == task_id:
+                    pipe.multi()
+                    pipe.hdel(LEASES, serial)
+                    pipe.execute()
+            except redis.WatchError:
+                pass
+
+    # leave the queue without a board, for tasks giving up
+    def withdraw(self, task_id, model_id, project_id):
+        me = task_id + "|" + str(project_id)
+        self.rdb.zrem(WAIT_PREFIX + model_id, me)
+        self.rdb.hdel(SEEN, me)
+
+
+# flash a bitstream with the toolchain image, passing through the leased board only
+class DockerProgrammer:
+
+    def program(self, device, PART_NAME, bitstream, TOP_FILE, output=None):
+        # the image sees the usual project layout with just the bitstream in it
+        prj_dir_host = tempfile.mkdtemp(prefix="program-")
+        try:
+            os.makedirs(os.path.join(prj_dir_host, "build"))
+            shutil.copyfile(bitstream, os.path.join(prj_dir_host, "build", "symbiflow.bit"))
+            prj_dir = CONTAINER_ROOT + "/program"
+            cmd = ["docker", "run", "--rm", "--device", device["path"]]
+            env = BuildEnv(PART_NAME, prj_dir, TOP_FILE, 2, "program")
+            env["DEVICE"] = device["path"]
+            for name, value in env.items():
+                cmd += ["-e", name + "=" + value]
+            cmd += ["-v", prj_dir_host + ":" + prj_dir, "symbiflow:" + PART_NAME]
+            # debug print
+            print(" ".join(cmd))
+            return Stream(cmd, output)
+        finally:
+            shutil.rmtree(prj_dir_host, ignore_errors=True)
+
+
+# stand-in board recording what was flashed on it
+class SimProgrammer:
+
+    def __init__(self, root=SIM_DIR, seconds=SIM_FLASH_SECONDS):
+        self.root = root
+        self.seconds = seconds
+
+    def program(self, device, PART_NAME, bitstream, TOP_FILE, output=None):
+        os.makedirs(self.root, exist_ok=True)
+        with open(bitstream, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if output:
+            output("flashing " + device["serial"] + " with " + digest)
+        time.sleep(self.seconds)
+        with open(os.path.join(self.root, device["serial"] + ".json"), "w") as f:
+            json.dump({"part": PART_NAME, "bitstream": digest, "top": TOP_FILE, "at": time.time()}, f)
+        return 0
+
+
+# programmer matching a board
+def ProgrammerFor(device):
+    return SimProgrammer() if device.get("sim") else DockerProgrammer()
@@ -0,0 +1,238 @@
+import os, json, signal, subprocess, threading, itertools, time
+from metrics import CONTAINER_START
+
+# projects are mounted below this path inside the containers
+CONTAINER_ROOT = "/symb"
+
+
+# toolchain environment passed to every build
+def BuildEnv(PART_NAME, PRJ_DIR, TOP_FILE, mode, stage, sources=None):
+    env = {"BOARD_MODEL": PART_NAME, "TOP_FILE": TOP_FILE, "PRJ_DIR": PRJ_DIR, "MODE": str(mode)}
+    # unset for images running the whole flow
+    if stage:
+        env["STAGE"] = stage
+    # files reachable from the top module, every file of the project when unset
+    if sources:
+        env["SOURCES"] = " ".join(sources)
+    return env
+
+
+# docker flags enforcing the limits of a build
+def LimitFlags(limits):
+    if not limits:
+        return []
+    return ["--cpuset-cpus", limits["cpuset"], "--memory", limits["memory"], "--memory-swap", limits["memory"]]
+
+
+# label of the containers started for a task
+TASK_LABEL = "symbiflask.task"
+
+
+# run a command, feeding its merged output line by line to the callback,
+# started gets the process so it can be killed
+def Stream(cmd, output=None, started=None, **kwargs):
+    if output is None:
+        proc = subprocess.Popen(cmd, **kwargs)
+        if started:
+            started(proc)
+        return proc.wait()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=1, universal_newlines=True, errors="replace", **kwargs)
+    if started:
+        started(proc)
+    for line in proc.stdout:
+        output(line.rstrip("\n"))
+    proc.stdout.close()
+    return proc.wait()
+
+
+# one container per build, the original behaviour
+class DockerExecutor:
+
+    def run(self, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode, stage, output=None, limits=None, task_id=None,
+            sources=None):
+        cmd = ["docker", "run", "--rm"] + LimitFlags(limits)
+        # named after the task so it can be found and killed
+        if task_id:
+            name = "symbiflask-" + task_id + ("-" + stage if stage else "")
+            cmd += ["--name", name, "--label", TASK_LABEL + "=" + task_id]
+        for name, value in BuildEnv(PART_NAME, PRJ_DIR, TOP_FILE, mode, stage, sources).items():
+            cmd += ["-e", name + "=" + value]
+        # no usb access, boards are flashed by the programming task
+        cmd += ["-v", PRJ_DIR_HOST + ":" + PRJ_DIR, "symbiflow:" + PART_NAME]
+        # debug print
+        print(" ".join(cmd))
+        return Stream(cmd, output)
+
+    def kill(self, task_id):
+        ids = subprocess.run(["docker", "ps", "-q", "--filter", "label=" + TASK_LABEL + "=" + task_id],
+                             stdout=subprocess.PIPE).stdout.decode().split()
+        if ids:
+            subprocess.call(["docker", "rm", "-f"] + ids, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# long lived container serving the builds of one project through docker exec
+class PooledContainer:
+
+    def __init__(self, name, PART_NAME, PRJ_DIR_HOST, PRJ_DIR):
+        self.name = name
+        self.PART_NAME = PART_NAME
+        self.PRJ_DIR_HOST = PRJ_DIR_HOST
+        self.builds = 0
+        self.killed = False
+        image = "symbiflow:" + PART_NAME
+        # the image entrypoint is replayed by docker exec for each build
+        out = subprocess.run(["docker", "image", "inspect", "--format",
+                              "{{json .Config.Entrypoint}}|{{json .Config.Cmd}}", image],
+                             stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+        entrypoint, cmd = out.split("|", 1)
+        self.command = (json.loads(entrypoint) or []) + (json.loads(cmd) or [])
+        started = time.time()
+        # only the project itself is mounted, never the app state or other projects
+        subprocess.run(["docker", "run", "-d", "--name", self.name,
+                        "-v", PRJ_DIR_HOST + ":" + PRJ_DIR,
+                        "--entrypoint", "sleep", image, "infinity"],
+                       stdout=subprocess.DEVNULL, check=True)
+        CONTAINER_START.labels(PART_NAME).observe(time.time() - started)
+
+    def healthy(self):
+        try:
+            return subprocess.call(["docker", "exec", self.name, "true"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+        except Exception as e:
+            print(e)
+            return False
+
+    def run(self, PART_NAME, PRJ_DIR, TOP_FILE, mode, stage, output=None, limits=None, sources=None):
+        # the warm container takes the limits of the build it serves
+        if limits:
+            subprocess.run(["docker", "update"] + LimitFlags(limits) + [self.name],
+                           stdout=subprocess.DEVNULL, check=True)
+        cmd = ["docker", "exec"]
+        for name, value in BuildEnv(PART_NAME, PRJ_DIR, TOP_FILE, mode, stage, sources).items():
+            cmd += ["-e", name + "=" + value]
+        cmd += ["-w", PRJ_DIR, self.name] + self.command
+        # debug print
+        print(" ".join(cmd))
+        self.builds += 1
+        return Stream(cmd, output)
+
+    def stop(self):
+        subprocess.call(["docker", "rm", "-f", self.name],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# per part pool of warm containers owned by one worker process. A container
+# only sees the project it was started for, so it is reused by the builds of
+# that project and gives way to other projects when the part is at capacity.
+class PoolExecutor:
+
+    def __init__(self, size, max_builds):
+        self.size = size
+        self.max_builds = max_builds
+        self.idle = {}
+        self.busy = {}
+        self.lock = threading.Condition()
+        self.counter = itertools.count()
+        # container serving each task
+        self.running = {}
+
+    def _lease(self, PART_NAME, PRJ_DIR_HOST, PRJ_DIR):
+        with self.lock:
+            while True:
+                # a container of this project, most recently released first
+                idle = self.idle.setdefault(PART_NAME, [])
+                for container in [c for c in reversed(idle) if c.PRJ_DIR_HOST == PRJ_DIR_HOST]:
+                    idle.remove(container)
+                    if container.healthy():
+                        self.busy[PART_NAME] = self.busy.get(PART_NAME, 0) + 1
+                        return container
+                    print("dropping unhealthy container " + container.name)
+                    container.stop()
+                if self.busy.get(PART_NAME, 0) < self.size:
+                    # the warm container of another project makes room
+                    if self.busy.get(PART_NAME, 0) + len(idle) >= self.size:
+                        idle.pop(0).stop()
+                    self.busy[PART_NAME] = self.busy.get(PART_NAME, 0) + 1
+                    break
+                self.lock.wait()
+        name = "symbiflask-%s-%d-%d" % (PART_NAME, os.getpid(), next(self.counter))
+        try:
+            return PooledContainer(name, PART_NAME, PRJ_DIR_HOST, PRJ_DIR)
+        except Exception:
+            self._release(PART_NAME, None)
+            raise
+
+    def _release(self, PART_NAME, container):
+        with self.lock:
+            self.busy[PART_NAME] -= 1
+            if container is not None:
+                # recycle containers that served enough builds or were killed mid build
+                if container.killed or container.builds >= self.max_builds:
+                    container.stop()
+                else:
+                    self.idle[PART_NAME].append(container)
+            self.lock.notify()
+
+    def run(self, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode, stage, output=None, limits=None, task_id=None,
+            sources=None):
+        container = self._lease(PART_NAME, PRJ_DIR_HOST, PRJ_DIR)
+        self.running[task_id] = container
+        try:
+            return container.run(PART_NAME, PRJ_DIR, TOP_FILE, mode, stage, output, limits, sources)
+        finally:
+            self.running.pop(task_id, None)
+            self._release(PART_NAME, container)
+
+    # a process inside a shared container cannot be told apart, the container goes
+    def kill(self, task_id):
+        container = self.running.get(task_id)
+        if container is not None:
+            container.killed = True
+            container.stop()
+
+    def shutdown(self):
+        with self.lock:
+            for containers in self.idle.values():
+                for container in containers:
+                    container.stop()
+            self.idle = {}
+
+
+# fake stand-in running a local script instead of the toolchain image
+class LocalExecutor:
+
+    def __init__(self, command):
+        self.command = command
+        self.procs = {}
+
+    def run(self, PART_NAME, PRJ_DIR, PRJ_DIR_HOST, TOP_FILE, mode, stage, output=None, limits=None, task_id=None,
+            sources=None):
+        env = dict(os.environ)
+        # the script works on the host dir directly
+        env.update(BuildEnv(PART_NAME, PRJ_DIR_HOST, TOP_FILE, mode, stage, sources))
+        try:
+            return Stream(self.command, output, started=lambda proc: self.procs.__setitem__(task_id, proc),
+                          shell=True, cwd=PRJ_DIR_HOST, env=env, start_new_session=True)
+        finally:
+            self.procs.pop(task_id, None)
+
+    def kill(self, task_id):
+        proc = self.procs.get(task_id)
+        if proc is not None:
+            try:
+                # the shell and everything it started
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+# pick the executor from the environment
+def MakeExecutor():
+    kind = os.environ.get("SYMBIFLASK_EXECUTOR", "pool")
+    if kind == "docker":
+        return DockerExecutor()
+    if kind == "local":
+        return LocalExecutor(os.environ.get("SYMBIFLASK_LOCAL_CMD", "true"))
+    return PoolExecutor(int(os.environ.get("SYMBIFLASK_POOL_SIZE", 1)),
+                        int(os.environ.get("SYMBIFLASK_POOL_MAX_BUILDS", 20)))
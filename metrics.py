@@ -0,0 +1,77 @@
+import os
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+# builds take minutes, requests milliseconds
+BUILD_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+# api side
+REQUEST_LATENCY = Histogram("symbiflask_request_seconds", "Request latency per resource",
+                            ["resource", "method", "status"])
+DB_QUERIES = Histogram("symbiflask_db_queries_per_request", "Database queries issued per request",
+                       ["resource", "method"], buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 34))
+
+# worker side
+QUEUE_WAIT = Histogram("symbiflask_queue_wait_seconds", "Time between enqueue and admission of a build",
+                       ["part"], buckets=BUILD_BUCKETS)
+BUILD_DURATION = Histogram("symbiflask_build_seconds", "RunSymbiFlow duration", ["part", "outcome"],
+                           buckets=BUILD_BUCKETS)
+STAGE_DURATION = Histogram("symbiflask_stage_seconds", "Toolchain stage duration", ["part", "stage"],
+                           buckets=BUILD_BUCKETS)
+CONTAINER_START = Histogram("symbiflask_container_start_seconds", "Warm container start time", ["part"])
+CACHE_LOOKUPS = Counter("symbiflask_build_cache_lookups_total", "Build cache lookups", ["result"])
+
+
+# depth of the build queues on the broker
+class QueueCollector:
+
+    def __init__(self, broker, prefix="symbiflow."):
+        self.broker = broker
+        self.prefix = prefix
+
+    def collect(self):
+        gauge = GaugeMetricFamily("symbiflask_queue_depth", "Builds waiting per queue", labels=["queue"])
+        depths = {}
+        try:
+            # priority levels live in separate lists named after the queue
+            for key in self.broker.scan_iter(match=self.prefix + "*", _type="list"):
+                queue = key.decode().split("\x06\x16")[0]
+                depths[queue] = depths.get(queue, 0) + self.broker.llen(key)
+        except Exception as e:
+            print(e)
+        for queue, depth in depths.items():
+            gauge.add_metric([queue], depth)
+        yield gauge
+
+
+# lifetime hit ratio of the build cache
+class CacheCollector:
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        gauge = GaugeMetricFamily("symbiflask_build_cache_hit_ratio", "Build cache hit ratio")
+        gauge.add_metric([], stats["hit_ratio"])
+        yield gauge
+        size = GaugeMetricFamily("symbiflask_build_cache_bytes", "Build cache size")
+        size.add_metric([], stats["size"])
+        yield size
+
+
+# registry for /metrics, aggregating worker processes when they share PROMETHEUS_MULTIPROC_DIR
+def MakeRegistry(*collectors):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    for collector in collectors:
+        registry.register(collector)
+    return registry
+
+
+def Exposition(registry):
+    return generate_latest(registry), CONTENT_TYPE_LATEST
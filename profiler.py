@@ -0,0 +1,85 @@
+import os, io, json, time, uuid, random, cProfile, pstats, datetime
+
+# opt-in profiling, off unless enabled
+PROFILING = os.environ.get("SYMBIFLASK_PROFILING", "0") == "1"
+# share of requests/builds profiled without being asked to
+PROFILE_SAMPLE = float(os.environ.get("SYMBIFLASK_PROFILE_SAMPLE", 0))
+PROFILE_DIR = os.environ.get("SYMBIFLASK_PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+# profiles kept on disk, oldest dropped first
+PROFILE_KEEP = int(os.environ.get("SYMBIFLASK_PROFILE_KEEP", 200))
+# header asking for a profile of one request
+PROFILE_HEADER = "X-Profile"
+
+
+# decide whether to profile, when profiling is enabled
+def ShouldProfile(requested):
+    return PROFILING and (requested or random.random() < PROFILE_SAMPLE)
+
+
+# start a cProfile, None when another profiler already runs in this interpreter
+def StartProfile():
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as e:
+        print(e)
+        return None
+    return profile
+
+
+# top functions of a profile as text
+def Summary(profile, limit=40):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+# profiles on local disk, json metadata next to the raw pstats dump
+class ProfileStore:
+
+    def __init__(self, root=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.root = root
+        self.keep = keep
+
+    def save(self, kind, name, profile, **extra):
+        os.makedirs(self.root, exist_ok=True)
+        profile_id = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        profile.dump_stats(os.path.join(self.root, profile_id + ".prof"))
+        record = dict(extra, id=profile_id, kind=kind, name=name, created=time.time(), summary=Summary(profile))
+        with open(os.path.join(self.root, profile_id + ".json"), "w") as f:
+            json.dump(record, f)
+        self._prune()
+        return profile_id
+
+    def list(self):
+        if not os.path.isdir(self.root):
+            return []
+        records = []
+        for name in sorted(os.listdir(self.root), reverse=True):
+            if name.endswith(".json"):
+                with open(os.path.join(self.root, name)) as f:
+                    record = json.load(f)
+                record.pop("summary", None)
+                record.pop("queries", None)
+                records.append(record)
+        return records
+
+    def get(self, profile_id):
+        path = os.path.join(self.root, os.path.basename(profile_id) + ".json")
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def raw_path(self, profile_id):
+        path = os.path.join(self.root, os.path.basename(profile_id) + ".prof")
+        return path if os.path.isfile(path) else None
+
+    def _prune(self):
+        names = sorted(n[:-5] for n in os.listdir(self.root) if n.endswith(".json"))
+        for profile_id in names[:max(0, len(names) - self.keep)]:
+            for ext in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.root, profile_id + ext))
+                except OSError:
+                    pass
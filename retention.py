@@ -0,0 +1,122 @@
+import os, shutil, zstandard
+from buildcache import BUILD_DIR, BITSTREAM
+from buildstages import STAGES, MANIFEST
+
+# bitstreams of past builds, content addressed and zstd compressed
+ARTIFACT_DIR = os.environ.get("SYMBIFLASK_ARTIFACT_DIR", os.path.join(os.getcwd(), "artifacts"))
+ZSTD_LEVEL = int(os.environ.get("SYMBIFLASK_ZSTD_LEVEL", 10))
+# bitstreams kept per project, newest builds first
+KEEP_BUILDS = int(os.environ.get("SYMBIFLASK_KEEP_BUILDS", 10))
+# intermediate outputs (netlists, placement, routing) kept per project
+INTERMEDIATE_MAX_BYTES = int(os.environ.get("SYMBIFLASK_INTERMEDIATE_MAX_BYTES", 512 << 20))
+
+
+# path of an archived bitstream
+def ArtifactPath(artifact_hash):
+    return os.path.join(ARTIFACT_DIR, artifact_hash[:2], artifact_hash + ".bit.zst")
+
+
+# archives written before compression
+def LegacyArtifactPath(artifact_hash):
+    return os.path.join(ARTIFACT_DIR, artifact_hash[:2], artifact_hash + ".bit")
+
+
+def IsArchived(artifact_hash):
+    return os.path.isfile(ArtifactPath(artifact_hash)) or os.path.isfile(LegacyArtifactPath(artifact_hash))
+
+
+# compress a bitstream into the archive, once per content
+def ArchiveBitstream(path, artifact_hash):
+    dst = ArtifactPath(artifact_hash)
+    if os.path.isfile(dst):
+        return dst
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + "." + str(os.getpid()) + ".tmp"
+    with open(path, "rb") as src, open(tmp, "wb") as out:
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, out)
+    os.replace(tmp, dst)
+    return dst
+
+
+# readable stream of an archived bitstream, decompressed as it is read, from
+# the archive or from a fetched copy of it
+def OpenArtifact(artifact_hash, archive=None):
+    path = archive or ArtifactPath(artifact_hash)
+    if os.path.isfile(path):
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    legacy = LegacyArtifactPath(artifact_hash)
+    if os.path.isfile(legacy):
+        return open(legacy, "rb")
+    return None
+
+
+def ArtifactChunks(artifact_hash, size=1 << 16, archive=None):
+    with OpenArtifact(artifact_hash, archive) as f:
+        for chunk in iter(lambda: f.read(size), b""):
+            yield chunk
+
+
+# decompress an archived bitstream to a plain file
+def ExtractArtifact(artifact_hash, dst, archive=None):
+    with open(dst + ".tmp", "wb") as out:
+        for chunk in ArtifactChunks(artifact_hash, archive=archive):
+            out.write(chunk)
+    os.replace(dst + ".tmp", dst)
+    return dst
+
+
+def RemoveArtifact(artifact_hash):
+    for path in (ArtifactPath(artifact_hash), LegacyArtifactPath(artifact_hash)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# bytes on disk below a path
+def DirSize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# drop intermediate outputs of a project beyond the byte budget. Stray files go
+# first, then the outputs of the earliest stages, which are the cheapest to
+# redo; the stage manifest notices the missing outputs and reruns only those.
+def PruneIntermediates(prj_dir, max_bytes=INTERMEDIATE_MAX_BYTES):
+    build_dir = os.path.join(prj_dir, BUILD_DIR)
+    if not os.path.isdir(build_dir):
+        return 0
+    size = DirSize(build_dir)
+    if size <= max_bytes:
+        return 0
+    keep = {BITSTREAM, BITSTREAM + ".sha256", MANIFEST}
+    stage_of = {}
+    for n, (stage, extensions) in enumerate(STAGES):
+        for name in os.listdir(build_dir):
+            if name.endswith(extensions) and name not in stage_of:
+                stage_of[name] = n
+    names = [name for name in os.listdir(build_dir) if name not in keep]
+    names.sort(key=lambda name: stage_of.get(name, -1))
+    freed = 0
+    for name in names:
+        if size - freed <= max_bytes:
+            break
+        path = os.path.join(build_dir, name)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                removed = DirSize(path)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                removed = os.lstat(path).st_size
+                os.remove(path)
+        except OSError as e:
+            print(e)
+            continue
+        freed += removed
+    return freed
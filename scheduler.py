@@ -0,0 +1,202 @@
+import os, json, time, socket, redis
+from artifactstore import STORE_URL
+
+# priority classes, the redis transport serves lower numbers first
+PRIORITIES = {"interactive": 0, "ci": 6}
+DEFAULT_PRIORITY = "interactive"
+
+# build cost per part as (cpus, memory in MiB)
+DEFAULT_COST = (2, 4096)
+COSTS = {
+    "xc7a35t": (2, 4096),
+    "xc7a50t": (2, 4096),
+    "xc7a100t": (4, 8192),
+    "xc7a200t": (8, 16384),
+    "xc7z010": (2, 4096),
+}
+COSTS.update({k: tuple(v) for k, v in json.loads(os.environ.get("SYMBIFLASK_BUILD_COSTS", "{}")).items()})
+
+# worker budget, defaults to the whole host
+CPU_BUDGET = int(os.environ.get("SYMBIFLASK_CPU_BUDGET", os.cpu_count() or 1))
+MEM_BUDGET = int(os.environ.get("SYMBIFLASK_MEM_BUDGET", 0))
+# seconds before a task that was not admitted is tried again
+ADMISSION_RETRY = int(os.environ.get("SYMBIFLASK_ADMISSION_RETRY", 10))
+# seconds the room freed by a preemption waits for the build it was made for
+HOLD_TTL = int(os.environ.get("SYMBIFLASK_HOLD_TTL", 6 * ADMISSION_RETRY))
+
+# wall clock limit of a build in seconds, by "part:mode", part or "default"
+TIMEOUTS = {"default": 4 * 3600}
+TIMEOUTS.update(json.loads(os.environ.get("SYMBIFLASK_BUILD_TIMEOUTS", "{}")))
+
+BUDGET_PREFIX = "symbiflask:budget:"
+# queue of the programming workers
+PROGRAM_QUEUE = "symbiflask.program"
+# queue of the worker next to the api, for tasks on its trash, blobs and artifacts
+API_QUEUE = "symbiflask.api"
+# tasks that must run on the api host once builds run on other hosts
+API_TASKS = ("celerytask.PurgeDeleted", "celerytask.PruneArtifacts")
+
+
+# total memory of the host in MiB
+def HostMemory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except Exception as e:
+        print(e)
+    return 0
+
+
+# queue of a part, so workers can be dedicated to families of parts
+def QueueFor(PART_NAME):
+    return "symbiflow." + PART_NAME
+
+
+# celery router sending every build to the queue of its part
+def RouteTask(name, args, kwargs, options, task=None, **kw):
+    if name == "celerytask.RunSymbiFlow" and kwargs.get("PART_NAME"):
+        return {"queue": QueueFor(kwargs["PART_NAME"])}
+    # boards are flashed by the hosts they are plugged into
+    if name == "celerytask.ProgramBoard":
+        return {"queue": PROGRAM_QUEUE}
+    # on a single host every worker sees the api files
+    if name in API_TASKS and STORE_URL:
+        return {"queue": API_QUEUE}
+    return None
+
+
+def PriorityFor(priority_class):
+    return PRIORITIES.get(priority_class, PRIORITIES[DEFAULT_PRIORITY])
+
+
+def TimeoutFor(PART_NAME, mode):
+    for key in (PART_NAME + ":" + str(mode), PART_NAME, "default"):
+        if key in TIMEOUTS:
+            return TIMEOUTS[key]
+    return None
+
+
+# a build bigger than the host still runs, alone
+def CostFor(PART_NAME, memory_budget=0):
+    cpus, memory = COSTS.get(PART_NAME, DEFAULT_COST)
+    return min(cpus, CPU_BUDGET), min(memory, memory_budget) if memory_budget else memory
+
+
+# cpu and memory reservations shared by the worker processes of a host
+class Budget:
+
+    def __init__(self, rdb, host=None):
+        self.rdb = rdb
+        self.key = BUDGET_PREFIX + (host or socket.gethostname())
+        self.cpus = CPU_BUDGET
+        self.memory = MEM_BUDGET or HostMemory()
+
+    # reservations of the host, without the held room nobody came back for
+    def _reservations(self, pipe):
+        reservations = {k.decode(): json.loads(v) for k, v in pipe.hgetall(self.key).items()}
+        now = time.time()
+        stale = [task_id for task_id, r in reservations.items() if r.get("held") and now - r["held"] > HOLD_TTL]
+        for task_id in stale:
+            del reservations[task_id]
+        return reservations, stale
+
+    # free cores and whether the memory fits, once the excluded builds are gone
+    def _room(self, reservations, memory, exclude=()):
+        kept = [r for task_id, r in reservations.items() if task_id not in exclude]
+        used_cores = {c for r in kept for c in r["cores"]}
+        used_memory = sum(r["memory"] for r in kept)
+        free_cores = [c for c in range(self.cpus) if c not in used_cores]
+        return free_cores, not self.memory or used_memory + memory <= self.memory
+
+    # reserve cores and memory for a build, None when it does not fit. The
+    # owner is the worker node holding the reservation.
+    def acquire(self, task_id, PART_NAME, priority=DEFAULT_PRIORITY, owner=None):
+        cpus, memory = CostFor(PART_NAME, self.memory)
+        with self.rdb.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    reservations, stale = self._reservations(pipe)
+                    # a retried task keeps its reservation, room held for it becomes its own
+                    if task_id in reservations:
+                        reservation = reservations[task_id]
+                        if reservation.pop("held", None):
+                            pipe.multi()
+                            pipe.hset(self.key, task_id, json.dumps(reservation))
+                            pipe.execute()
+                        else:
+                            pipe.unwatch()
+                        return reservation
+                    free_cores, memory_fits = self._room(reservations, memory)
+                    if len(free_cores) < cpus or not memory_fits:
+                        pipe.unwatch()
+                        return None
+                    reservation = {"cores": free_cores[:cpus], "memory": memory, "priority": PriorityFor(priority),
+                                   "since": time.time(), "owner": owner}
+                    pipe.multi()
+                    if stale:
+                        pipe.hdel(self.key, *stale)
+                    pipe.hset(self.key, task_id, json.dumps(reservation))
+                    pipe.execute()
+                    return reservation
+                except redis.WatchError:
+                    continue
+
+    def release(self, task_id):
+        self.rdb.hdel(self.key, task_id)
+
+    # running builds of lower priority classes to stop so a build fits, lowest
+    # class and newest first. Their room is held for the build right away, so
+    # the stopped builds cannot take it back when they are queued again. Empty
+    # when stopping every candidate would still not be enough.
+    def preempt(self, task_id, PART_NAME, priority=DEFAULT_PRIORITY, owner=None):
+        cpus, memory = CostFor(PART_NAME, self.memory)
+        level = PriorityFor(priority)
+        with self.rdb.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    reservations, stale = self._reservations(pipe)
+                    if task_id in reservations:
+                        pipe.unwatch()
+                        return []
+                    candidates = sorted(((r.get("priority", level), r.get("since", 0), other)
+                                         for other, r in reservations.items()
+                                         if r.get("priority", level) > level and not r.get("held")), reverse=True)
+                    victims = []
+                    free_cores, memory_fits = self._room(reservations, memory)
+                    for _, _, victim in candidates:
+                        if len(free_cores) >= cpus and memory_fits:
+                            break
+                        victims.append(victim)
+                        free_cores, memory_fits = self._room(reservations, memory, victims)
+                    if not victims or len(free_cores) < cpus or not memory_fits:
+                        pipe.unwatch()
+                        return []
+                    now = time.time()
+                    hold = {"cores": free_cores[:cpus], "memory": memory, "priority": level,
+                            "since": now, "owner": owner, "held": now}
+                    pipe.multi()
+                    if stale:
+                        pipe.hdel(self.key, *stale)
+                    pipe.hset(self.key, task_id, json.dumps(hold))
+                    pipe.execute()
+                    return victims
+                except redis.WatchError:
+                    continue
+
+    # drop reservations left behind by a previous run of a worker node, other
+    # workers on the host keep theirs
+    def reset(self, owner):
+        reservations = {k.decode(): json.loads(v) for k, v in self.rdb.hgetall(self.key).items()}
+        stale = [task_id for task_id, r in reservations.items() if r.get("owner") == owner]
+        if stale:
+            self.rdb.hdel(self.key, *stale)
+
+
+# container limits matching a reservation
+def Limits(reservation):
+    return {"cpuset": ",".join(str(c) for c in reservation["cores"]),
+            "memory": str(reservation["memory"]) + "m"}
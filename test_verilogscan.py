@@ -0,0 +1,95 @@
+import unittest
+from verilogscan import ScanVerilog, CheckHierarchy
+
+SUB = """
+module sub(input a, output y);
+  assign y = ~a;
+endmodule
+"""
+
+
+# scan a {file name: source} project, None for files that are not verilog
+def Scan(project):
+    return {name: ScanVerilog(text) if text is not None else None for name, text in project.items()}
+
+
+class ScanVerilogTest(unittest.TestCase):
+
+    def instances(self, body):
+        return ScanVerilog("module top(input a, output y);\n" + body + "\nendmodule\n")["instances"]["top"]
+
+    def test_plain_instance(self):
+        self.assertEqual(self.instances("sub u(.a(a), .y(y));"), ["sub"])
+
+    def test_parameters_and_arrays(self):
+        self.assertEqual(self.instances("sub #(.W(8)) u [3:0] (.a(a), .y(y));"), ["sub"])
+
+    def test_after_conditional_directives(self):
+        body = "`ifdef X\n  sub u(.a(a), .y(y));\n`else\n  alt v(.a(a), .y(y));\n`endif\n  last w(.a(a), .y(y));"
+        self.assertEqual(self.instances(body), ["sub", "alt", "last"])
+
+    def test_after_line_directives(self):
+        body = "`define W 8\n  sub u(.a(a), .y(y));"
+        self.assertEqual(self.instances(body), ["sub"])
+
+    def test_after_function_and_task(self):
+        body = ("function f(input x); f = x; endfunction\n  sub u(.a(a), .y(y));\n"
+                "task t; begin end endtask\n  alt v(.a(a), .y(y));")
+        self.assertEqual(self.instances(body), ["sub", "alt"])
+
+    def test_after_attribute(self):
+        self.assertEqual(self.instances("(* keep_hierarchy *) sub u(.a(a), .y(y));"), ["sub"])
+
+    def test_sensitivity_list_is_not_an_attribute(self):
+        body = "always @(*) begin end\n  sub u(.a(a), .y(y));"
+        self.assertEqual(self.instances(body), ["sub"])
+
+    def test_gate_primitives(self):
+        self.assertEqual(self.instances("and g1(y, a, a);"), [])
+
+    def test_comments_and_strings(self):
+        body = '// fake u(.a(a));\n/* fake v(.a(a)); */\ninitial $display("fake w(.a(a));");'
+        self.assertEqual(self.instances(body), [])
+
+    def test_declarations_and_includes(self):
+        scan = ScanVerilog('`include "defs.vh"\nprimitive p(o, i); table 0:1; endtable endprimitive\n' + SUB)
+        self.assertEqual(scan["modules"], ["p", "sub"])
+        self.assertEqual(scan["includes"], ["defs.vh"])
+
+
+class CheckHierarchyTest(unittest.TestCase):
+
+    def test_instance_under_ifdef_is_reachable(self):
+        top = "module top(input a, output y);\n`ifdef X\n  sub u(.a(a), .y(y));\n`endif\nendmodule\n"
+        files = Scan({"top.v": top, "sub.v": SUB, "pins.xdc": None})
+        self.assertEqual(CheckHierarchy(files, "top.v"), (None, ["pins.xdc", "sub.v", "top.v"], None))
+
+    def test_unused_library_module_is_skipped(self):
+        top = "module top(input a, output y);\n  sub u(.a(a), .y(y));\nendmodule\n"
+        lib = SUB + "module unused(input a); missing m(.a(a)); endmodule\n"
+        error, reachable, warning = CheckHierarchy(Scan({"top.v": top, "lib.v": lib}), "top.v")
+        self.assertEqual((error, reachable, warning), (None, ["lib.v", "top.v"], None))
+
+    def test_unknown_cell_warns(self):
+        top = "module top(input a, output y);\n  vendor_ip u(.a(a), .y(y));\n  IBUF b(.I(a), .O(y));\nendmodule\n"
+        error, reachable, warning = CheckHierarchy(Scan({"top.v": top}), "top.v")
+        self.assertIsNone(error)
+        self.assertEqual(warning, "modules not found in project: vendor_ip")
+
+    def test_missing_include_fails(self):
+        top = '`include "defs.vh"\nmodule top; endmodule\n'
+        error, _, _ = CheckHierarchy(Scan({"top.v": top}), "top.v")
+        self.assertEqual(error, "Error: included files not found in project: defs.vh")
+
+    def test_duplicated_module_fails(self):
+        top = "module top(input a, output y);\n  sub u(.a(a), .y(y));\nendmodule\n"
+        error, _, _ = CheckHierarchy(Scan({"top.v": top, "a.v": SUB, "b.v": SUB}), "top.v")
+        self.assertEqual(error, "Error: modules declared more than once: sub")
+
+    def test_vhdl_disables_the_check(self):
+        files = Scan({"top.v": "module top; missing m(.a(a)); endmodule\n", "ip.vhd": None})
+        self.assertEqual(CheckHierarchy(files, "top.v"), (None, ["ip.vhd", "top.v"], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os, uuid, shutil
+from sqlalchemy import select
+from buildhistory import database
+# deleted project dirs and files wait here for the purge task, same filesystem as the projects
+TRASH_DIR = os.environ.get("SYMBIFLASK_TRASH_DIR", os.path.join(os.getcwd(), ".trash"))
+# rows deleted per transaction
+PURGE_BATCH = int(os.environ.get("SYMBIFLASK_PURGE_BATCH", 500))
+
+
+# move a path out of the way in constant time, None when it is already gone
+def Trash(path):
+    if not os.path.exists(path):
+        return None
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    dst = os.path.join(TRASH_DIR, uuid.uuid4().hex + "-" + os.path.basename(path))
+    os.rename(path, dst)
+    return dst
+
+
+# remove a tree file by file, reporting the count every batch
+def RemoveTree(path, progress=None, every=PURGE_BATCH):
+    if os.path.isfile(path) or os.path.islink(path):
+        os.remove(path)
+        return 1
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            try:
+                os.remove(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+            removed += 1
+            if progress and removed % every == 0:
+                progress(removed)
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                pass
+    shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+# worker side remover of the rows tombstoned by the api
+class Purger:
+
+    def __init__(self, db=database, batch=PURGE_BATCH):
+        self.db = db
+        self.batch = batch
+        self.engine = None
+
+    def _connect(self):
+        if self.engine is None:
+            self.project = self.db.table("Project")
+            self.hdl = self.db.table("HDL_file")
+            self.build = self.db.table("Build")
+            self.engine = self.db.engine
+        return self.engine
+
+    # delete matching rows a batch at a time, returning the hashes they referenced
+    # (file contents, or bitstreams for the build history)
+    def _delete(self, table, where, progress=None):
+        engine = self._connect()
+        hashes = set()
+        deleted = 0
+        while True:
+            with engine.begin() as conn:
+                column = table.c.content_hash if table is self.hdl else table.c.artifact_hash
+                rows = conn.execute(select(table.c.id, column).where(where).limit(self.batch)).all()
+                if not rows:
+                    return deleted, hashes
+                hashes.update(row[1] for row in rows if row[1])
+                conn.execute(table.delete().where(table.c.id.in_([row[0] for row in rows])))
+            deleted += len(rows)
+            if progress:
+                progress(deleted)
+
+    def tombstoned_projects(self):
+        self._connect()
+        with self.engine.connect() as conn:
+            return [row[0] for row in conn.execute(select(self.project.c.id).where(self.project.c.deleted_at.isnot(None)))]
+
+    # files and build history of a project, then the project itself, returning
+    # the content and bitstream hashes they referenced
+    def purge_project(self, Project_id, progress=None):
+        self._connect()
+        deleted, hashes = self._delete(self.hdl, self.hdl.c.Project_id == Project_id, progress)
+        _, artifacts = self._delete(self.build, self.build.c.Project_id == Project_id)
+        with self.engine.begin() as conn:
+            conn.execute(self.project.delete().where(self.project.c.id == Project_id, self.project.c.deleted_at.isnot(None)))
+        return deleted, hashes, artifacts
+
+    # tombstoned files, or every tombstoned file when no id is given
+    def purge_files(self, file_ids=None, progress=None):
+        self._connect()
+        where = self.hdl.c.deleted_at.isnot(None)
+        if file_ids is not None:
+            where = where & self.hdl.c.id.in_(list(file_ids))
+        return self._delete(self.hdl, where, progress)
+
+    # blobs still referenced by a row
+    def referenced(self, hashes):
+        self._connect()
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(select(self.hdl.c.content_hash).where(self.hdl.c.content_hash.in_(list(hashes))).distinct())}
@@ -0,0 +1,230 @@
+import os, re, json
+
+# files the scanner understands, anything else is passed through untouched
+VERILOG_EXTENSIONS = (".v", ".sv", ".vh", ".svh")
+# sources the scanner cannot read, their modules are unknown
+OTHER_HDL_EXTENSIONS = (".vhd", ".vhdl")
+# cells provided by the toolchain libraries, never uploaded. Other names the
+# project does not declare are reported as warnings, the list is not complete.
+KNOWN_CELLS = {
+    "BUFG", "BUFGCE", "BUFGCE_1", "BUFGCTRL", "BUFGMUX", "BUFGMUX_1", "BUFGMUX_CTRL", "BUFH", "BUFHCE", "BUFIO",
+    "BUFR", "BUFMR", "BUFMRCE",
+    "IBUF", "IBUFG", "IBUFDS", "IBUFGDS", "IBUFDS_DIFF_OUT", "IBUFDS_GTE2", "IBUF_IBUFDISABLE", "IBUF_INTERMDISABLE",
+    "OBUF", "OBUFT", "OBUFDS", "OBUFTDS", "IOBUF", "IOBUFDS", "IOBUF_DCIEN", "IOBUF_INTERMDISABLE",
+    "PULLUP", "PULLDOWN", "KEEPER",
+    "IDDR", "IDDR_2CLK", "ODDR", "IDELAYE2", "IDELAYE2_FINEDELAY", "ODELAYE2", "IDELAYCTRL", "ISERDESE2", "OSERDESE2",
+    "IN_FIFO", "OUT_FIFO", "PHASER_IN", "PHASER_OUT", "PHASER_REF",
+    "MMCME2_ADV", "MMCME2_BASE", "PLLE2_ADV", "PLLE2_BASE",
+    "RAMB18E1", "RAMB36E1", "FIFO18E1", "FIFO36E1",
+    "RAM16X1S", "RAM32X1S", "RAM64X1S", "RAM128X1S", "RAM256X1S", "RAM16X1D", "RAM32X1D", "RAM64X1D", "RAM128X1D",
+    "RAM256X1D", "RAM32M", "RAM64M", "RAM32X16DR8", "RAM64X8SW", "ROM32X1", "ROM64X1", "ROM128X1", "ROM256X1",
+    "SRL16E", "SRLC16E", "SRLC32E", "CFGLUT5",
+    "DSP48E1", "CARRY4", "MUXF7", "MUXF8", "LUT1", "LUT2", "LUT3", "LUT4", "LUT5", "LUT6", "LUT6_2",
+    "FDRE", "FDSE", "FDCE", "FDPE", "LDCE", "LDPE", "VCC", "GND",
+    "STARTUPE2", "ICAPE2", "CAPTUREE2", "FRAME_ECCE2", "USR_ACCESSE2", "EFUSE_USR", "XADC", "BSCANE2", "DNA_PORT",
+    "PS7", "GTPE2_CHANNEL", "GTPE2_COMMON", "GTXE2_CHANNEL", "GTXE2_COMMON", "PCIE_2_1",
+}
+KNOWN_CELLS.update(filter(None, os.environ.get("SYMBIFLASK_KNOWN_CELLS", "").split(",")))
+
+# words that open a statement without instantiating anything, gate
+# primitives included
+KEYWORDS = {
+    "alias", "always", "always_comb", "always_ff", "always_latch", "and", "assert", "assign", "assume", "automatic",
+    "begin", "bind", "bit", "break", "buf", "bufif0", "bufif1", "byte", "case", "casex", "casez", "chandle", "class",
+    "clocking", "cmos", "const", "constraint", "continue", "cover", "covergroup", "deassign", "default", "defparam",
+    "disable", "do", "else", "end", "endcase", "endclass", "endclocking", "endfunction", "endgenerate",
+    "endgroup", "endinterface", "endmodule", "endpackage", "endprimitive", "endprogram", "endproperty",
+    "endsequence", "endspecify", "endtable", "endtask", "enum", "event", "export", "extern", "final", "for",
+    "force", "foreach", "forever", "fork", "function", "generate", "genvar", "highz0", "highz1", "if", "iff",
+    "import", "initial", "inout", "input", "int", "integer", "interface", "join", "join_any", "join_none", "large",
+    "let", "localparam", "logic", "longint", "macromodule", "medium", "modport", "module", "nand", "negedge", "nmos",
+    "nor", "not", "notif0", "notif1", "or", "output", "package", "packed", "parameter", "pmos", "posedge",
+    "primitive", "priority", "program", "property", "pull0", "pull1", "pulldown", "pullup", "rand", "randc",
+    "randcase", "rcmos", "real", "realtime", "ref", "reg", "release", "repeat", "restrict", "return", "rnmos",
+    "rpmos", "rtran", "rtranif0", "rtranif1", "scalared", "sequence", "shortint", "shortreal", "signed", "small",
+    "specify", "specparam", "static", "string", "strong0", "strong1", "struct", "supply0", "supply1", "table",
+    "task", "time", "tran", "tranif0", "tranif1", "tri", "tri0", "tri1", "triand", "trior", "trireg", "type",
+    "typedef", "union", "unique", "unique0", "unsigned", "uwire", "var", "vectored", "void", "wait", "wand",
+    "weak0", "weak1", "while", "wire", "wor", "xnor", "xor",
+}
+# declarations whose name can be instantiated, with the word closing them;
+# only modules, interfaces and programs contain instances
+DECLARATIONS = {"module": "endmodule", "macromodule": "endmodule", "interface": "endinterface",
+                "program": "endprogram", "primitive": "endprimitive"}
+CONTAINERS = {"module", "macromodule", "interface", "program"}
+# scan results by content hash, versioned with their layout
+SCAN_KEY = "symbiflask:verilog-scan:3"
+# tokens after which a new statement starts, conditional directives included
+STATEMENT_START = {";", "begin", "end", "generate", "endgenerate", "else", "endcase", "endfunction", "endtask",
+                   "endspecify", "endclocking", "endproperty", "endsequence", "endgroup", "join", "join_any",
+                   "join_none", "`else", "`endif"}
+# conditional directives followed by a macro name
+CONDITIONALS = {"`ifdef", "`ifndef", "`elsif"}
+
+COMMENTS = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+STRINGS = re.compile(r'"(?:\\.|[^"\\])*"')
+INCLUDES = re.compile(r'`include\s+"([^"]+)"')
+# directives running to the end of their line, continuations included
+LINE_DIRECTIVES = re.compile(r"`(?:define|undef|undefineall|include|timescale|default_nettype|line|pragma|resetall|"
+                             r"celldefine|endcelldefine|unconnected_drive|nounconnected_drive)\b(?:\\\n|[^\n])*")
+# (* attributes *), not the @(*) sensitivity list
+ATTRIBUTES = re.compile(r"\(\*(?!\s*\)).*?\*\)", re.S)
+TOKENS = re.compile(r"`?[A-Za-z_][A-Za-z0-9_$]*|\\\S+|[()\[\];#:,.=]")
+
+
+# skip a balanced group starting at tokens[i] == opening, returning the index after it
+def _skip(tokens, i, opening, closing):
+    depth = 0
+    while i < len(tokens):
+        if tokens[i] == opening:
+            depth += 1
+        elif tokens[i] == closing:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+# declared modules, the names each of them instantiates and the included
+# files of a source
+def ScanVerilog(text):
+    text = COMMENTS.sub(" ", text)
+    includes = sorted(set(INCLUDES.findall(text)))
+    text = STRINGS.sub('""', text)
+    # attributes and line directives are transparent to the statements around them
+    text = ATTRIBUTES.sub(" ", LINE_DIRECTIVES.sub(" ", text))
+    tokens = TOKENS.findall(text)
+    modules, instances = [], {}
+    i, current, closing, start = 0, None, None, False
+    while i < len(tokens):
+        token = tokens[i]
+        # named blocks, begin : label
+        if start and token == ":":
+            i += 2
+            continue
+        # `ifdef NAME, a new statement follows the macro name
+        if token in CONDITIONALS:
+            i, start = i + 2, True
+            continue
+        if closing is None and token in DECLARATIONS and i + 1 < len(tokens):
+            modules.append(tokens[i + 1])
+            closing = DECLARATIONS[token]
+            current = tokens[i + 1] if token in CONTAINERS else None
+            if current is not None:
+                instances.setdefault(current, [])
+            # skip the header up to its closing semicolon
+            while i < len(tokens) and tokens[i] != ";":
+                i = _skip(tokens, i, "(", ")") if tokens[i] == "(" else i + 1
+            start = True
+            i += 1
+            continue
+        if token == closing:
+            current, closing, start = None, None, False
+        elif current is not None and start and token[0] not in "`(#;" and token not in KEYWORDS:
+            # cell [#(params)] name [range] (ports)
+            j = i + 1
+            if j < len(tokens) and tokens[j] == "#":
+                j = _skip(tokens, j + 1, "(", ")")
+            if j < len(tokens) and (tokens[j][0] == "\\" or
+                                    (tokens[j][0].isalpha() or tokens[j][0] == "_") and tokens[j] not in KEYWORDS):
+                k = j + 1
+                if k < len(tokens) and tokens[k] == "[":
+                    k = _skip(tokens, k, "[", "]")
+                if k < len(tokens) and tokens[k] == "(" and token not in instances[current]:
+                    instances[current].append(token)
+        start = token in STATEMENT_START
+        i += 1
+    return {"modules": modules, "instances": instances, "includes": includes}
+
+
+def IsVerilog(file_name):
+    return file_name.lower().endswith(VERILOG_EXTENSIONS)
+
+
+def ScanFile(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return ScanVerilog(f.read())
+
+
+# check the hierarchy below the modules of the top file, returns (error,
+# reachable file names, warning) from {file name: scan, None for files that
+# are not verilog}. Constraints and other inputs are always passed on. Names
+# neither declared in the project nor known cells only warn, they may be
+# library cells missing from KNOWN_CELLS.
+def CheckHierarchy(files, top_file):
+    # other languages may hold modules the scanner cannot see, keep every file
+    if files.get(top_file) is None or any(name.lower().endswith(OTHER_HDL_EXTENSIONS) for name in files):
+        return None, sorted(files), None
+    if not files[top_file]["modules"]:
+        return "Error: top level file " + top_file + " declares no module", None, None
+    declared = {}
+    for name, scan in files.items():
+        if scan is None:
+            continue
+        for module in scan["modules"]:
+            declared.setdefault(module, []).append(name)
+    by_basename = {os.path.basename(name): name for name in files}
+
+    reachable = {name for name, scan in files.items() if scan is None}
+    seen = set(files[top_file]["modules"])
+    queue = list(seen)
+    visited_files = set()
+    unknown, duplicated, unresolved = set(), set(), set()
+    while queue:
+        module = queue.pop()
+        owners = declared[module]
+        if len(owners) > 1:
+            duplicated.add(module)
+        # a module pulls in its file and whatever that file includes
+        pending = list(owners)
+        while pending:
+            name = pending.pop()
+            if name in visited_files:
+                continue
+            visited_files.add(name)
+            reachable.add(name)
+            for include in files[name]["includes"]:
+                if os.path.basename(include) not in by_basename:
+                    unresolved.add(include)
+                elif files[by_basename[os.path.basename(include)]] is not None:
+                    pending.append(by_basename[os.path.basename(include)])
+        for name in owners:
+            for cell in files[name]["instances"].get(module, []):
+                if cell in declared:
+                    if cell not in seen:
+                        seen.add(cell)
+                        queue.append(cell)
+                elif cell not in KNOWN_CELLS:
+                    unknown.add(cell)
+
+    if unresolved:
+        return "Error: included files not found in project: " + ", ".join(sorted(unresolved)), None, None
+    if duplicated:
+        return "Error: modules declared more than once: " + ", ".join(sorted(duplicated)), None, None
+    warning = "modules not found in project: " + ", ".join(sorted(unknown)) if unknown else None
+    return None, sorted(reachable), warning
+
+
+# scan results keyed by content hash, shared by every project holding the content
+class ScanIndex:
+
+    def __init__(self, rdb):
+        self.rdb = rdb
+
+    # scan a stored verilog content unless it is already indexed
+    def index(self, content_hash, path, file_name):
+        if IsVerilog(file_name) and not self.rdb.hexists(SCAN_KEY, content_hash):
+            self.put(content_hash, ScanFile(path))
+
+    def put(self, content_hash, scan):
+        self.rdb.hset(SCAN_KEY, content_hash, json.dumps(scan))
+
+    def get(self, content_hashes):
+        if not content_hashes:
+            return []
+        return [json.loads(v) if v is not None else None for v in self.rdb.hmget(SCAN_KEY, content_hashes)]
+
+    def drop(self, content_hashes):
+        if content_hashes:
+            self.rdb.hdel(SCAN_KEY, *content_hashes)